@@ -2,18 +2,53 @@ from sqlalchemy.orm import Session
 from sqlalchemy import text
 from typing import List, Dict, Any
 
+import profiling
+from database import STORAGE_FORMAT
+
+# compactレイアウトの価格倍率 (storage_metaから一度だけ読み込む)
+_price_scale_cache: Dict[str, float] = {}
+
+def _is_compact() -> bool:
+    return STORAGE_FORMAT == "compact"
+
+def _get_table_name(timeframe: str) -> str:
+    if _is_compact():
+        return f"ohlcv_{timeframe}_compact"
+    return f"ohlcv_{timeframe}"
+
+def _get_price_scale(db: Session) -> float:
+    """compactレイアウトで価格を整数保存している場合の倍率を返す (REAL保存なら1.0)"""
+    if "value" not in _price_scale_cache:
+        row = db.execute(text("SELECT value FROM storage_meta WHERE key = 'price_scale_decimals'")).fetchone()
+        _price_scale_cache["value"] = float(10 ** int(row[0])) if row else 1.0
+    return _price_scale_cache["value"]
+
 def get_symbols_exceeding_threshold(db: Session, timeframe: str, price_threshold: float, offset: int, direction: str, sort: str, limit: int):
     """
     指定されたタイムフレームと閾値に基づいて、価格変動率が大きい銘柄のリストを取得します。
     offsetを使用して、何本前の足と比較するかを指定できます。
     """
-    table_name = f"ohlcv_{timeframe}"
+    table_name = _get_table_name(timeframe)
+
+    # compactレイアウトではシンボルIDで集計し、最後に辞書テーブルからシンボル名を引く
+    if _is_compact():
+        key_col = "symbol_id"
+        close_expr = "close * 1.0 / :price_scale"
+        symbol_col = "s.symbol"
+        symbol_join = "INNER JOIN symbols s ON s.symbol_id = lc.symbol_id"
+        price_scale = _get_price_scale(db)
+    else:
+        key_col = "symbol"
+        close_expr = "close"
+        symbol_col = "lc.symbol"
+        symbol_join = ""
+        price_scale = 1.0
 
     # ソート順をSQLのORDER BY句に変換
     sort_map = {
         "volatility_desc": "volatility_pct DESC",
         "volatility_asc": "volatility_pct ASC",
-        "symbol_asc": "lc.symbol ASC",
+        "symbol_asc": f"{symbol_col} ASC",
     }
     order_by_clause = sort_map.get(sort, "volatility_pct DESC")
 
@@ -23,16 +58,16 @@ def get_symbols_exceeding_threshold(db: Session, timeframe: str, price_threshold
         WITH ranked_candles AS (
             -- 各シンボルについて、タイムスタンプの降順で連番を振る
             SELECT
-                symbol,
+                {key_col},
                 timestamp,
-                close,
-                ROW_NUMBER() OVER (PARTITION BY symbol ORDER BY timestamp DESC) as rn
+                {close_expr} as close,
+                ROW_NUMBER() OVER (PARTITION BY {key_col} ORDER BY timestamp DESC) as rn
             FROM {table_name}
         ),
         latest_candles AS (
             -- 最新の足 (rn=1)
             SELECT
-                symbol,
+                {key_col},
                 timestamp,
                 close
             FROM ranked_candles
@@ -41,21 +76,22 @@ def get_symbols_exceeding_threshold(db: Session, timeframe: str, price_threshold
         previous_candles AS (
             -- N本前の足 (rn=1+offset)
             SELECT
-                symbol,
+                {key_col},
                 close as prev_close
             FROM ranked_candles
             WHERE rn = 1 + :offset
         )
         -- 最新の足とN本前の足を結合し、変動率を計算
         SELECT
-            lc.symbol,
+            {symbol_col} as symbol,
             lc.timestamp as candle_ts,
             lc.close,
             pc.prev_close,
             ((lc.close - pc.prev_close) / pc.prev_close) * 100 AS volatility_pct,
             :timeframe as timeframe
         FROM latest_candles lc
-        INNER JOIN previous_candles pc ON lc.symbol = pc.symbol
+        INNER JOIN previous_candles pc ON lc.{key_col} = pc.{key_col}
+        {symbol_join}
         WHERE
             -- 閾値でのフィルタリング
             ABS(((lc.close - pc.prev_close) / pc.prev_close) * 100) >= :price_threshold
@@ -77,10 +113,12 @@ def get_symbols_exceeding_threshold(db: Session, timeframe: str, price_threshold
             "offset": offset,
             "direction": direction,
             "limit": limit,
-            "timeframe": timeframe
+            "timeframe": timeframe,
+            "price_scale": price_scale
         }
     )
-    return result.fetchall()
+    with profiling.span("fetch"):
+        return result.fetchall()
 
 from datetime import datetime, timedelta
 
@@ -98,17 +136,21 @@ def _parse_period_to_seconds(period_str: str) -> int:
     # Add more units if needed (e.g., 'min' for minutes, 's' for seconds)
     raise ValueError(f"Unsupported period unit: {period_str}")
 
+def get_period_start_ts_ms(period_str: str) -> int:
+    """Returns the start of the period (e.g. '24h' ago) as a millisecond timestamp."""
+    # Convert period string to seconds, then to milliseconds for timestamp comparison
+    period_seconds = _parse_period_to_seconds(period_str)
+    end_ts = datetime.utcnow()
+    start_ts = end_ts - timedelta(seconds=period_seconds)
+    return int(start_ts.timestamp() * 1000)
+
 def get_volume_for_period(db: Session, timeframe: str, period_str: str, sort: str, limit: int, min_volume: float = 0, min_volume_target: str = "turnover") -> List[Any]:
     """
     指定された期間とタイムフレームに基づいて、各銘柄の合計出来高を取得します。
     """
-    table_name = f"ohlcv_{timeframe}"
+    table_name = _get_table_name(timeframe)
 
-    # Convert period string to seconds, then to milliseconds for timestamp comparison
-    period_seconds = _parse_period_to_seconds(period_str)
-    end_ts = datetime.utcnow()
-    start_ts = end_ts - timedelta(seconds=period_seconds)
-    start_ts_ms = int(start_ts.timestamp() * 1000)
+    start_ts_ms = get_period_start_ts_ms(period_str)
 
     # Sort order mapping
     sort_map = {
@@ -129,21 +171,46 @@ def get_volume_for_period(db: Session, timeframe: str, period_str: str, sort: st
             having_clause = "HAVING SUM(turnover) > :min_volume"
 
 
-    query = text(f"""
-        SELECT
-            symbol,
-            SUM(volume) as total_volume,
-            SUM(turnover) as total_turnover
-        FROM {table_name}
-        WHERE
-            timestamp >= :start_ts_ms
-        GROUP BY
-            symbol
-        {having_clause}
-        ORDER BY
-            {order_by_clause}
-        LIMIT :limit
-    """)
+    if _is_compact():
+        # シンボルIDで集計してから辞書テーブルと結合する
+        query = text(f"""
+            SELECT
+                s.symbol as symbol,
+                agg.total_volume,
+                agg.total_turnover
+            FROM (
+                SELECT
+                    symbol_id,
+                    SUM(volume) as total_volume,
+                    SUM(turnover) as total_turnover
+                FROM {table_name}
+                WHERE
+                    timestamp >= :start_ts_ms
+                GROUP BY
+                    symbol_id
+                {having_clause}
+            ) agg
+            INNER JOIN symbols s ON s.symbol_id = agg.symbol_id
+            ORDER BY
+                {order_by_clause}
+            LIMIT :limit
+        """)
+    else:
+        query = text(f"""
+            SELECT
+                symbol,
+                SUM(volume) as total_volume,
+                SUM(turnover) as total_turnover
+            FROM {table_name}
+            WHERE
+                timestamp >= :start_ts_ms
+            GROUP BY
+                symbol
+            {having_clause}
+            ORDER BY
+                {order_by_clause}
+            LIMIT :limit
+        """)
 
     result = db.execute(
         query,
@@ -153,4 +220,111 @@ def get_volume_for_period(db: Session, timeframe: str, period_str: str, sort: st
             "min_volume": min_volume
         }
     )
-    return result.fetchall()
+    with profiling.span("fetch"):
+        return result.fetchall()
+
+def _get_change_log_table() -> str:
+    if _is_compact():
+        return "change_log_compact"
+    return "change_log"
+
+def get_change_log_bounds(db: Session) -> Any:
+    """
+    変更ログに残っている最小のシーケンス番号と、最後に採番されたシーケンス番号を取得します。
+    max_seq は削除済みの変更も含めた採番済みの最大値で、ログが空の場合も0以上になります。
+    """
+    log_table = _get_change_log_table()
+    return db.execute(
+        text(f"""
+            SELECT
+                (SELECT MIN(seq) FROM {log_table}) as min_seq,
+                COALESCE((SELECT seq FROM sqlite_sequence WHERE name = :log_table), 0) as max_seq
+        """),
+        {"log_table": log_table}
+    ).fetchone()
+
+def get_changes_since(db: Session, since: int, limit: int, timeframe: str = None) -> List[Any]:
+    """
+    指定されたシーケンス番号より後に挿入・更新された足を、シーケンス順に取得します。
+    """
+    log_table = _get_change_log_table()
+    timeframe_clause = "AND c.timeframe = :timeframe" if timeframe else ""
+
+    if _is_compact():
+        query = text(f"""
+            SELECT
+                c.seq, c.op, c.timeframe, s.symbol as symbol, c.timestamp,
+                c.open * 1.0 / :price_scale as open,
+                c.high * 1.0 / :price_scale as high,
+                c.low * 1.0 / :price_scale as low,
+                c.close * 1.0 / :price_scale as close,
+                c.volume, c.turnover
+            FROM {log_table} c
+            INNER JOIN symbols s ON s.symbol_id = c.symbol_id
+            WHERE c.seq > :since {timeframe_clause}
+            ORDER BY c.seq
+            LIMIT :limit
+        """)
+        price_scale = _get_price_scale(db)
+    else:
+        query = text(f"""
+            SELECT
+                c.seq, c.op, c.timeframe, c.symbol, c.timestamp,
+                c.open, c.high, c.low, c.close, c.volume, c.turnover
+            FROM {log_table} c
+            WHERE c.seq > :since {timeframe_clause}
+            ORDER BY c.seq
+            LIMIT :limit
+        """)
+        price_scale = 1.0
+
+    result = db.execute(
+        query,
+        {
+            "since": since,
+            "limit": limit,
+            "timeframe": timeframe,
+            "price_scale": price_scale
+        }
+    )
+    with profiling.span("fetch"):
+        return result.fetchall()
+
+def get_symbol_coverage(db: Session, timeframe: str) -> List[Any]:
+    """
+    各銘柄について、保存されている足の本数と最古・最新のタイムスタンプを取得します。
+    """
+    table_name = _get_table_name(timeframe)
+
+    if _is_compact():
+        query = text(f"""
+            SELECT
+                s.symbol as symbol,
+                agg.candles,
+                agg.first_ts,
+                agg.last_ts
+            FROM (
+                SELECT
+                    symbol_id,
+                    COUNT(*) as candles,
+                    MIN(timestamp) as first_ts,
+                    MAX(timestamp) as last_ts
+                FROM {table_name}
+                GROUP BY symbol_id
+            ) agg
+            INNER JOIN symbols s ON s.symbol_id = agg.symbol_id
+        """)
+    else:
+        query = text(f"""
+            SELECT
+                symbol,
+                COUNT(*) as candles,
+                MIN(timestamp) as first_ts,
+                MAX(timestamp) as last_ts
+            FROM {table_name}
+            GROUP BY symbol
+        """)
+
+    result = db.execute(query)
+    with profiling.span("fetch"):
+        return result.fetchall()
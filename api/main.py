@@ -1,4 +1,5 @@
 import os
+import secrets
 from fastapi import Depends, FastAPI, HTTPException, Query, Request
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
@@ -7,8 +8,10 @@ from typing import List
 from enum import Enum
 
 import crud
+import profiling
 import schemas
 from database import engine, get_db
+from snapshot import snapshot_store
 
 app = FastAPI(
     title="CMMA API",
@@ -18,6 +21,44 @@ app = FastAPI(
     openapi_url="/volatility/openapi.json"
 )
 
+# --- プロファイリング (管理者のみ) ---
+async def profile_request(request: Request, call_next):
+    token = request.headers.get(profiling.PROFILE_TOKEN_HEADER)
+    if token is None:
+        return await call_next(request)
+    # 非ASCII文字を含むstrは compare_digest で TypeError になるため、バイト列で比較する
+    if not secrets.compare_digest(token.encode("utf-8"), profiling.PROFILE_ADMIN_TOKEN.encode("utf-8")):
+        return JSONResponse(
+            status_code=403,
+            content=schemas.ErrorResponse(
+                error=schemas.ErrorDetail(code="PROFILE_FORBIDDEN", message="プロファイリングの権限がありません。")
+            ).model_dump(),
+        )
+
+    profile, context_token = profiling.start_profile(f"{request.method} {request.url.path}")
+    try:
+        response = await call_next(request)
+    finally:
+        profiling.end_profile(context_token)
+    total_ms = profile.finish()
+    server_timing = profile.server_timing(total_ms)
+
+    if request.headers.get(profiling.PROFILE_FORMAT_HEADER, "").lower() == "trace":
+        # 本文の代わりにトレースを返す (元のレスポンス本文は読み捨てる)
+        async for _ in response.body_iterator:
+            pass
+        trace = profile.to_chrome_trace()
+        trace["otherData"] = {"url": str(request.url), "status_code": response.status_code, "total_ms": total_ms}
+        return JSONResponse(trace, headers={"Server-Timing": server_timing})
+
+    response.headers["Server-Timing"] = server_timing
+    return response
+
+# ミドルウェアとSQLの計測は全リクエストに処理時間が加わるため、トークンが設定されている場合だけ組み込む
+if profiling.PROFILE_ADMIN_TOKEN:
+    profiling.install_sql_timing(engine)
+    app.middleware("http")(profile_request)
+
 # --- エラーハンドリング ---
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
@@ -86,34 +127,49 @@ def read_volatility(
             headers={"X-Error-Code": "INVALID_TIMEFRAME"},
         )
     
-    results = crud.get_symbols_exceeding_threshold(
-        db=db, 
-        timeframe=timeframe, 
-        price_threshold=price_threshold,
-        offset=offset,
-        direction=direction.value,
-        sort=sort.value,
-        limit=limit
-    )
+    # fetcherが共有スナップショットを書き出している場合は、SQLを使わずmmap上の配列から計算する
+    snapshot = snapshot_store.get(timeframe) if snapshot_store else None
+    if snapshot is not None:
+        with profiling.span("snapshot"):
+            results = snapshot.get_symbols_exceeding_threshold(
+                timeframe=timeframe,
+                price_threshold=price_threshold,
+                offset=offset,
+                direction=direction.value,
+                sort=sort.value,
+                limit=limit
+            )
+    else:
+        results = crud.get_symbols_exceeding_threshold(
+            db=db,
+            timeframe=timeframe,
+            price_threshold=price_threshold,
+            offset=offset,
+            direction=direction.value,
+            sort=sort.value,
+            limit=limit
+        )
     
     # crudからの結果をレスポンスモデルに変換
-    volatility_data = [
-        schemas.VolatilityData(
-            symbol=row.symbol,
-            timeframe=row.timeframe,
-            candle_ts=row.candle_ts,
-            price=schemas.PriceInfo(
-                close=row.close,
-                prev_close=row.prev_close
-            ),
-            change=schemas.ChangeInfo(
-                pct=round(row.volatility_pct, 4),
-                direction="up" if row.volatility_pct > 0 else "down"
-            )
-        ) for row in results
-    ]
+    with profiling.span("build"):
+        volatility_data = [
+            schemas.VolatilityData(
+                symbol=row.symbol,
+                timeframe=row.timeframe,
+                candle_ts=row.candle_ts,
+                price=schemas.PriceInfo(
+                    close=row.close,
+                    prev_close=row.prev_close
+                ),
+                change=schemas.ChangeInfo(
+                    pct=round(row.volatility_pct, 4),
+                    direction="up" if row.volatility_pct > 0 else "down"
+                )
+            ) for row in results
+        ]
+        response = schemas.VolatilityResponse(count=len(volatility_data), data=volatility_data)
 
-    return schemas.VolatilityResponse(count=len(volatility_data), data=volatility_data)
+    return response
 
 @app.get("/", include_in_schema=False)
 def read_root():
@@ -219,24 +275,169 @@ def read_volume(
             headers={"X-Error-Code": "INSUFFICIENT_HISTORY"}
         )
 
-    results = crud.get_volume_for_period(
-        db=db,
-        timeframe=timeframe,
-        period_str=period,
-        sort=sort.value,
-        limit=limit,
-        min_volume=min_volume or 0,
-        min_volume_target=min_volume_target.value,
-    )
+    snapshot = snapshot_store.get(timeframe) if snapshot_store else None
+    if snapshot is not None:
+        with profiling.span("snapshot"):
+            results = snapshot.get_volume_for_period(
+                start_ts_ms=crud.get_period_start_ts_ms(period),
+                sort=sort.value,
+                limit=limit,
+                min_volume=min_volume or 0,
+                min_volume_target=min_volume_target.value,
+            )
+    else:
+        results = crud.get_volume_for_period(
+            db=db,
+            timeframe=timeframe,
+            period_str=period,
+            sort=sort.value,
+            limit=limit,
+            min_volume=min_volume or 0,
+            min_volume_target=min_volume_target.value,
+        )
+
+    with profiling.span("build"):
+        volume_data = [
+            schemas.VolumeData(
+                symbol=row.symbol,
+                total_volume=round(row.total_volume, 4),
+                total_turnover=round(row.total_turnover, 4),
+                timeframe=timeframe,
+                period=period
+            ) for row in results
+        ]
+        response = schemas.VolumeResponse(count=len(volume_data), data=volume_data)
+
+    return response
+
+CHANGE_OPS = {"I": "insert", "U": "update"}
+
+@app.get(
+    "/changes",
+    response_model=schemas.ChangesResponse,
+    summary="前回以降に変更された足を取得",
+    response_description="指定したシーケンス番号より後に挿入・更新された足"
+)
+def read_changes(
+    since: int = Query(0, ge=0, description="最後に受け取った変更のシーケンス番号。初回は0。"),
+    timeframe: str = Query(None, description=f"タイムフレームで絞り込む場合に指定。有効値: {', '.join(VALID_TIMEFRAMES)}"),
+    limit: int = Query(1000, gt=0, le=10000, description="取得する最大件数"),
+    db: Session = Depends(get_db)
+):
+    if timeframe is not None and timeframe not in VALID_TIMEFRAMES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"無効なタイムフレームです。有効な値: {', '.join(VALID_TIMEFRAMES)}",
+            headers={"X-Error-Code": "INVALID_TIMEFRAME"},
+        )
 
-    volume_data = [
-        schemas.VolumeData(
-            symbol=row.symbol,
-            total_volume=round(row.total_volume, 4),
-            total_turnover=round(row.total_turnover, 4),
+    # 1件多く取得して、続きがあるかを判定する
+    results = crud.get_changes_since(db=db, since=since, limit=limit + 1, timeframe=timeframe)
+    has_more = len(results) > limit
+    results = results[:limit]
+
+    # 範囲の確認は取得の後に行う。取得中にfetcherが古いログを削除した場合も、
+    # 取得した範囲の手前に欠けがないことを保証できる (最小のseqは増える方向にしか変わらない)
+    bounds = crud.get_change_log_bounds(db)
+    # ログが空の場合は、次に採番される seq から残っているものとみなす
+    min_seq = bounds.min_seq if bounds.min_seq is not None else bounds.max_seq + 1
+
+    # 保持期間を過ぎて削除された変更がある場合は、差分では同期できないため全件の再取得を促す
+    if since < min_seq - 1:
+        raise HTTPException(
+            status_code=410,
+            detail=f"seq {since} 以降の変更ログは既に削除されています (保持している最小のseq: {min_seq})。"
+                   f"/volatility や /volume などで全件を取得し直してから、since={bounds.max_seq} で同期を再開してください。",
+            headers={"X-Error-Code": "CHANGES_EXPIRED"},
+        )
+    # 採番済みの最大値より大きい since は、別のDBやリセット前のログのもの。そのまま待つと変更を取りこぼす
+    if since > bounds.max_seq:
+        raise HTTPException(
+            status_code=410,
+            detail=f"seq {since} はまだ採番されていません (最後に採番されたseq: {bounds.max_seq})。"
+                   f"変更ログがリセットされた可能性があります。全件を取得し直してから、since={bounds.max_seq} で同期を再開してください。",
+            headers={"X-Error-Code": "CHANGES_EXPIRED"},
+        )
+
+    with profiling.span("build"):
+        change_data = [
+            schemas.ChangeData(
+                seq=row.seq,
+                op=CHANGE_OPS.get(row.op, row.op),
+                symbol=row.symbol,
+                timeframe=row.timeframe,
+                candle_ts=row.timestamp,
+                open=row.open,
+                high=row.high,
+                low=row.low,
+                close=row.close,
+                volume=row.volume,
+                turnover=row.turnover
+            ) for row in results
+        ]
+
+        next_since = change_data[-1].seq if change_data else since
+        response = schemas.ChangesResponse(count=len(change_data), next_since=next_since, has_more=has_more, data=change_data)
+
+    return response
+
+@app.get(
+    "/coverage",
+    response_model=schemas.CoverageResponse,
+    summary="OHLCVデータの欠損状況を取得",
+    response_description="タイムフレーム全体と、欠損の多い銘柄の充足率"
+)
+def read_coverage(
+    timeframe: str = Query(..., description=f"タイムフレームを指定。有効値: {', '.join(VALID_TIMEFRAMES)} (1Mを除く)"),
+    limit: int = Query(100, gt=0, le=500, description="返す銘柄の最大件数 (欠損の多い順)"),
+    db: Session = Depends(get_db)
+):
+    if timeframe not in VALID_TIMEFRAMES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"無効なタイムフレームです。有効な値: {', '.join(VALID_TIMEFRAMES)}",
+            headers={"X-Error-Code": "INVALID_TIMEFRAME"},
+        )
+    # 月足は月ごとに間隔が異なるため、欠損を判定できない
+    if timeframe == "1M":
+        raise HTTPException(
+            status_code=400,
+            detail="1Mは足の間隔が一定でないため、欠損状況を計算できません。",
+            headers={"X-Error-Code": "UNSUPPORTED_TIMEFRAME"},
+        )
+
+    interval_ms = _parse_timeframe_to_minutes(timeframe) * 60 * 1000
+    results = crud.get_symbol_coverage(db=db, timeframe=timeframe)
+
+    with profiling.span("build"):
+        coverage_data = []
+        for row in results:
+            expected = (row.last_ts - row.first_ts) // interval_ms + 1
+            coverage_data.append(
+                schemas.SymbolCoverage(
+                    symbol=row.symbol,
+                    candles=row.candles,
+                    expected=expected,
+                    missing=max(0, expected - row.candles),
+                    coverage_pct=round(row.candles / expected * 100, 4),
+                    first_ts=row.first_ts,
+                    last_ts=row.last_ts
+                )
+            )
+
+        expected_total = sum(c.expected for c in coverage_data)
+        missing_total = sum(c.missing for c in coverage_data)
+        with_gaps = sorted((c for c in coverage_data if c.missing > 0), key=lambda c: c.missing, reverse=True)[:limit]
+
+        response = schemas.CoverageResponse(
             timeframe=timeframe,
-            period=period
-        ) for row in results
-    ]
+            symbols=len(coverage_data),
+            symbols_with_gaps=sum(1 for c in coverage_data if c.missing > 0),
+            expected_candles=expected_total,
+            missing_candles=missing_total,
+            coverage_pct=round((expected_total - missing_total) / expected_total * 100, 4) if expected_total else 100.0,
+            count=len(with_gaps),
+            data=with_gaps
+        )
 
-    return schemas.VolumeResponse(count=len(volume_data), data=volume_data)
+    return response
@@ -0,0 +1,125 @@
+"""
+管理者向けの単一リクエストのプロファイリング。
+
+PROFILE_ADMIN_TOKEN を設定し、リクエストヘッダー X-Profile-Token に同じ値を指定した場合だけ、
+そのリクエストの処理時間を区間ごとに計測してレスポンスに付けて返す。
+
+    sql:       SQLの実行 (カーソルのexecute)
+    fetch:     結果行の取り出し (fetchall による行オブジェクトの生成)
+    snapshot:  共有スナップショットからの計算 (SQLの代わりに使われた場合)
+    build:     結果行からレスポンスモデルへの変換
+    serialize: エンドポイントの終了からレスポンス送信開始まで (レスポンスモデルの検証とJSONへの変換)
+
+計測結果は Server-Timing ヘッダー (ブラウザの開発者ツールで表示できる) で返す。
+X-Profile-Format: trace を指定した場合は、レスポンス本文の代わりに
+Chrome Trace Event形式のJSON (Perfetto / chrome://tracing / speedscope で開ける) を返す。
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_TOKEN_HEADER = "X-Profile-Token"
+PROFILE_FORMAT_HEADER = "X-Profile-Format"
+
+# Server-Timingヘッダーに出力する区間 (この順で出力する)
+SERVER_TIMING_SPANS = ["sql", "fetch", "snapshot", "build", "serialize"]
+
+
+class RequestProfile:
+    """1リクエスト分の区間の記録"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started_ns = time.perf_counter_ns()
+        # (区間名, 開始ns, 終了ns)
+        self.spans: List[Tuple[str, int, int]] = []
+
+    def add_span(self, name: str, start_ns: int, end_ns: int):
+        self.spans.append((name, start_ns, end_ns))
+
+    @contextmanager
+    def span(self, name: str):
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.add_span(name, start_ns, time.perf_counter_ns())
+
+    def finish(self) -> float:
+        """
+        レスポンスの送信開始時に呼び出し、全体の処理時間 (ミリ秒) を返す。
+        最後の build 区間の終了からここまでを serialize 区間として記録する。
+        """
+        end_ns = time.perf_counter_ns()
+        build_ends = [span_end for name, _, span_end in self.spans if name == "build"]
+        if build_ends:
+            self.add_span("serialize", max(build_ends), end_ns)
+        return (end_ns - self.started_ns) / 1e6
+
+    def totals(self) -> Dict[str, Tuple[float, int]]:
+        """区間名ごとの (合計ミリ秒, 回数)"""
+        totals: Dict[str, Tuple[float, int]] = {}
+        for name, start_ns, end_ns in self.spans:
+            total_ms, count = totals.get(name, (0.0, 0))
+            totals[name] = (total_ms + (end_ns - start_ns) / 1e6, count + 1)
+        return totals
+
+    def server_timing(self, total_ms: float) -> str:
+        totals = self.totals()
+        entries = []
+        for name in SERVER_TIMING_SPANS:
+            if name in totals:
+                dur_ms, count = totals[name]
+                entries.append(f'{name};dur={dur_ms:.3f};desc="{count}x"')
+        entries.append(f"total;dur={total_ms:.3f}")
+        return ", ".join(entries)
+
+    def to_chrome_trace(self) -> dict:
+        """Chrome Trace Event形式 (タイムスタンプはマイクロ秒)"""
+        events = [{"name": "process_name", "ph": "M", "pid": 1, "tid": 1, "args": {"name": self.name}}]
+        for name, start_ns, end_ns in sorted(self.spans, key=lambda s: (s[1], -s[2])):
+            events.append({
+                "name": name, "cat": "request", "ph": "X", "pid": 1, "tid": 1,
+                "ts": (start_ns - self.started_ns) / 1000, "dur": (end_ns - start_ns) / 1000,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+_current_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("current_profile", default=None)
+
+
+def start_profile(name: str) -> Tuple[RequestProfile, contextvars.Token]:
+    profile = RequestProfile(name)
+    return profile, _current_profile.set(profile)
+
+
+def end_profile(token: contextvars.Token):
+    _current_profile.reset(token)
+
+
+def span(name: str):
+    """プロファイル中のリクエストであれば区間を記録する (それ以外では何もしない)"""
+    profile = _current_profile.get()
+    return profile.span(name) if profile else nullcontext()
+
+
+def install_sql_timing(engine: Engine):
+    """プロファイル中のリクエストで実行されたSQLの時間を sql 区間として記録する"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current_profile.get() is not None:
+            conn.info.setdefault("profile_query_start_ns", []).append(time.perf_counter_ns())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        starts = conn.info.get("profile_query_start_ns")
+        if profile is not None and starts:
+            profile.add_span("sql", starts.pop(), time.perf_counter_ns())
@@ -49,3 +49,48 @@ class VolumeResponse(BaseModel):
     """出来高APIレスポンス全体"""
     count: int = Field(..., description="返されたデータ件数")
     data: List[VolumeData]
+
+class ChangeData(BaseModel):
+    """変更ログの1件 (挿入または更新された足)"""
+    seq: int = Field(..., description="変更のシーケンス番号。次回は最後に受け取った値を`since`に指定します。")
+    op: str = Field(..., description="変更種別 ('insert' または 'update')")
+    symbol: str = Field(..., description="銘柄シンボル")
+    timeframe: str = Field(..., description="タイムフレーム")
+    candle_ts: int = Field(..., description="ローソク足の開始タイムスタンプ (ミリ秒)")
+    open: float = Field(..., description="始値")
+    high: float = Field(..., description="高値")
+    low: float = Field(..., description="安値")
+    close: float = Field(..., description="終値")
+    volume: float = Field(..., description="出来高")
+    turnover: float = Field(..., description="売買代金")
+
+    class Config:
+        from_attributes = True
+
+class ChangesResponse(BaseModel):
+    """変更ログAPIレスポンス全体"""
+    count: int = Field(..., description="返されたデータ件数")
+    next_since: int = Field(..., description="次回のリクエストで`since`に指定する値")
+    has_more: bool = Field(..., description="`limit`件を超える変更が残っている場合はtrue")
+    data: List[ChangeData]
+
+class SymbolCoverage(BaseModel):
+    """銘柄ごとの欠損状況"""
+    symbol: str = Field(..., description="銘柄シンボル")
+    candles: int = Field(..., description="保存されている足の本数")
+    expected: int = Field(..., description="最古の足から最新の足までに本来あるべき足の本数")
+    missing: int = Field(..., description="欠損している足の本数")
+    coverage_pct: float = Field(..., description="充足率 (%)")
+    first_ts: int = Field(..., description="最古の足の開始タイムスタンプ (ミリ秒)")
+    last_ts: int = Field(..., description="最新の足の開始タイムスタンプ (ミリ秒)")
+
+class CoverageResponse(BaseModel):
+    """欠損状況レポート全体"""
+    timeframe: str = Field(..., description="タイムフレーム")
+    symbols: int = Field(..., description="銘柄数")
+    symbols_with_gaps: int = Field(..., description="欠損のある銘柄数")
+    expected_candles: int = Field(..., description="本来あるべき足の本数の合計")
+    missing_candles: int = Field(..., description="欠損している足の本数の合計")
+    coverage_pct: float = Field(..., description="全体の充足率 (%)")
+    count: int = Field(..., description="返された銘柄の件数")
+    data: List[SymbolCoverage] = Field(..., description="欠損の多い順の銘柄一覧")
@@ -0,0 +1,160 @@
+"""
+fetcherが書き出す共有マーケットスナップショット (snapshot_{tf}.bin) の読み取り。
+
+ファイルを読み取り専用で mmap し、NumPyのビュー (コピーなし) として参照するため、
+複数のワーカープロセスが同じページキャッシュを共有する。
+ファイル形式の定義は fetcher/snapshot.py を参照。
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+SNAPSHOT_ENABLED = os.getenv("SNAPSHOT_ENABLED", "false").lower() == "true"
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "./data/snapshots")
+# fetcherが書き出し (または変更なしの確認) をしてからこの秒数を過ぎたスナップショットは使わず、DBから計算する
+SNAPSHOT_MAX_AGE_SECONDS = float(
+    os.getenv("SNAPSHOT_MAX_AGE_SECONDS", str(3 * int(os.getenv("FETCH_INTERVAL_SECONDS", "300"))))
+)
+
+SNAPSHOT_MAGIC = b"CMMASNAP"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<8sIIIIqqQQQQQQQ")
+
+# crudの結果 (SQLAlchemyのRow) と同じ属性名で参照できるようにする
+VolatilityRow = namedtuple("VolatilityRow", ["symbol", "candle_ts", "close", "prev_close", "volatility_pct", "timeframe"])
+VolumeRow = namedtuple("VolumeRow", ["symbol", "total_volume", "total_turnover"])
+
+
+class MarketSnapshot:
+    """1タイムフレーム分のスナップショット"""
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, format_version, n_symbols, depth, _, self.generation, self.created_at_ms,
+         symbols_offset, symbols_size, ts_offset, close_offset, volume_offset, turnover_offset,
+         counts_offset) = SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC or format_version != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"未対応のスナップショット形式です: {path}")
+
+        symbols_bytes = self._mm[symbols_offset:symbols_offset + symbols_size]
+        self.symbols = symbols_bytes.decode("utf-8").split("\n") if n_symbols else []
+
+        shape = (n_symbols, depth)
+        size = n_symbols * depth
+        self.timestamps = np.frombuffer(self._mm, dtype="<i8", count=size, offset=ts_offset).reshape(shape)
+        self.close = np.frombuffer(self._mm, dtype="<f8", count=size, offset=close_offset).reshape(shape)
+        self.volume = np.frombuffer(self._mm, dtype="<f8", count=size, offset=volume_offset).reshape(shape)
+        self.turnover = np.frombuffer(self._mm, dtype="<f8", count=size, offset=turnover_offset).reshape(shape)
+        self.counts = np.frombuffer(self._mm, dtype="<i4", count=n_symbols, offset=counts_offset)
+
+    def get_symbols_exceeding_threshold(self, timeframe: str, price_threshold: float, offset: int, direction: str,
+                                        sort: str, limit: int) -> List[VolatilityRow]:
+        """crud.get_symbols_exceeding_threshold と同じ条件で、スナップショットから変動率を計算します。"""
+        if offset >= self.close.shape[1]:
+            return []
+
+        close = self.close[:, 0]
+        prev_close = self.close[:, offset]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = (close - prev_close) / prev_close
+            pct = ratio * 100
+
+        mask = (self.counts > offset) & np.isfinite(pct) & (np.abs(pct) >= price_threshold)
+        if direction == "up":
+            mask &= ratio > 0
+        elif direction == "down":
+            mask &= ratio < 0
+
+        idx = np.flatnonzero(mask)
+        # 銘柄は名前順に並んでいるので、symbol_ascはそのままの順序になる
+        if sort == "volatility_asc":
+            idx = idx[np.argsort(pct[idx], kind="stable")]
+        elif sort != "symbol_asc":
+            idx = idx[np.argsort(-pct[idx], kind="stable")]
+        idx = idx[:limit]
+
+        return [
+            VolatilityRow(self.symbols[i], int(self.timestamps[i, 0]), float(close[i]), float(prev_close[i]),
+                          float(pct[i]), timeframe)
+            for i in idx
+        ]
+
+    def get_volume_for_period(self, start_ts_ms: int, sort: str, limit: int, min_volume: float = 0,
+                              min_volume_target: str = "turnover") -> List[VolumeRow]:
+        """crud.get_volume_for_period と同じ条件で、スナップショットから期間内の合計出来高を計算します。"""
+        in_period = self.timestamps >= start_ts_ms
+        total_volume = np.where(in_period, self.volume, 0.0).sum(axis=1)
+        total_turnover = np.where(in_period, self.turnover, 0.0).sum(axis=1)
+
+        mask = in_period.any(axis=1)
+        if min_volume > 0:
+            target = total_volume if min_volume_target == "volume" else total_turnover
+            mask &= target > min_volume
+
+        idx = np.flatnonzero(mask)
+        sort_keys = {
+            "volume_desc": -total_volume,
+            "volume_asc": total_volume,
+            "turnover_desc": -total_turnover,
+            "turnover_asc": total_turnover,
+        }
+        if sort in sort_keys:
+            idx = idx[np.argsort(sort_keys[sort][idx], kind="stable")]
+        elif sort != "symbol_asc":
+            idx = idx[np.argsort(-total_volume[idx], kind="stable")]
+        idx = idx[:limit]
+
+        return [VolumeRow(self.symbols[i], float(total_volume[i]), float(total_turnover[i])) for i in idx]
+
+
+class SnapshotStore:
+    """
+    タイムフレームごとのスナップショットを保持し、fetcherがファイルを差し替えたら次のリクエストで開き直す。
+    古いmmapは参照中のリクエストが終わるとGCで解放される。
+    fetcherが書き出しを止めた場合 (エラーや SNAPSHOT_ENABLED の設定漏れ) に古いデータを返し続けないよう、
+    ファイルの更新時刻から max_age_seconds を過ぎたスナップショットは使わない。
+    """
+
+    def __init__(self, directory: str, max_age_seconds: float):
+        self.directory = Path(directory)
+        self.max_age_seconds = max_age_seconds
+        self._snapshots: Dict[str, Tuple[Tuple[int, int], MarketSnapshot]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, timeframe: str) -> Optional[MarketSnapshot]:
+        path = self.directory / f"snapshot_{timeframe}.bin"
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if time.time() - st.st_mtime > self.max_age_seconds:
+            self._snapshots.pop(timeframe, None)
+            return None
+        file_id = (st.st_ino, st.st_mtime_ns)
+
+        cached = self._snapshots.get(timeframe)
+        if cached and cached[0] == file_id:
+            return cached[1]
+
+        with self._lock:
+            cached = self._snapshots.get(timeframe)
+            if cached and cached[0] == file_id:
+                return cached[1]
+            try:
+                snapshot = MarketSnapshot(path)
+            except (OSError, ValueError, struct.error):
+                return None
+            self._snapshots[timeframe] = (file_id, snapshot)
+            return snapshot
+
+
+snapshot_store = SnapshotStore(SNAPSHOT_DIR, SNAPSHOT_MAX_AGE_SECONDS) if SNAPSHOT_ENABLED else None
@@ -1,50 +1,138 @@
 import aiohttp
 import asyncio
 import logging
-from typing import List, Any, Optional
+import time
+from typing import Dict, List, Any, Optional
+from urllib.parse import urlparse
+
+from profiling import CycleProfiler
+from retry import CircuitBreaker, FetchError
+
+# 再試行で回復する可能性のあるBybitのretCode
+# 10000: サーバータイムアウト, 10006: リクエスト過多, 10016: サーバーエラー, 10018: IPレートリミット超過
+RETRYABLE_RET_CODES = {10000, 10006, 10016, 10018}
+# 403はBybitではIPレートリミット超過を表す
+RETRYABLE_HTTP_STATUSES = {403, 408, 429, 500, 502, 503, 504}
 
 class BybitClient:
-    def __init__(self, base_url: str, logger: logging.Logger):
+    def __init__(self, base_url: str, logger: logging.Logger, circuit_failure_threshold: int = 20,
+                 circuit_cooldown_seconds: float = 30.0, profiler: Optional[CycleProfiler] = None):
         self.base_url = base_url
         self.logger = logger
+        # 設定されている場合は、K線取得の通信時間とパース時間を集計する
+        self.profiler = profiler
         self.timeout = aiohttp.ClientTimeout(total=10)
+        self.circuit_failure_threshold = circuit_failure_threshold
+        self.circuit_cooldown_seconds = circuit_cooldown_seconds
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get_breaker(self, url: Optional[str] = None) -> CircuitBreaker:
+        host = urlparse(url or self.base_url).netloc
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(host, self.circuit_failure_threshold, self.circuit_cooldown_seconds)
+        return self.breakers[host]
+
+    def _record_success(self, breaker: CircuitBreaker):
+        if breaker.record_success():
+            self.logger.info(f"{breaker.host} への接続が復旧しました。サーキットブレーカーを閉じます。")
+
+    def _record_failure(self, breaker: CircuitBreaker):
+        if breaker.record_failure():
+            self.logger.warning(
+                f"{breaker.host} で {breaker.consecutive_failures} 回連続して失敗したため、"
+                f"{breaker.cooldown_seconds:.0f}秒間リクエストを遮断します。"
+            )
+
+    @staticmethod
+    def _retry_after(response: aiohttp.ClientResponse) -> Optional[float]:
+        """レートリミットのリセット時刻ヘッダー (ミリ秒) から、再試行までの秒数を求める"""
+        reset_ts = response.headers.get("X-Bapi-Limit-Reset-Timestamp")
+        try:
+            return max(0.0, int(reset_ts) / 1000 - time.time()) if reset_ts else None
+        except ValueError:
+            return None
 
     async def get_all_linear_symbols(self, session: aiohttp.ClientSession) -> List[str]:
         url = f"{self.base_url}/v5/market/instruments-info"
+        breaker = self.get_breaker(url)
         symbols, cursor = [], ""
         self.logger.info("全Linear銘柄(USDT無期限)を取得中...")
         while True:
             params = {"category": "linear", "status": "Trading", "limit": 1000, "cursor": cursor}
             try:
+                breaker.before_request()
                 async with session.get(url, params={k: v for k, v in params.items() if v}) as response:
                     response.raise_for_status()
                     data = await response.json()
                     if data["retCode"] != 0:
                         self.logger.error(f"APIエラー: {data['retMsg']}")
-                        break
+                        if data["retCode"] in RETRYABLE_RET_CODES:
+                            self._record_failure(breaker)
+                        else:
+                            self._record_success(breaker)
+                        # 一部のページだけの銘柄一覧は使わない
+                        return []
+                    self._record_success(breaker)
                     result = data.get("result", {})
                     symbols.extend([item["symbol"] for item in result.get("list", []) if item.get("symbol", "").endswith("USDT")])
                     cursor = result.get("nextPageCursor", "")
                     if not cursor: break
                     await asyncio.sleep(0.1)
-            except aiohttp.ClientError as e:
+            except FetchError as e:
                 self.logger.error(f"銘柄取得リクエストエラー: {e}")
                 return []
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self._record_failure(breaker)
+                self.logger.error(f"銘柄取得リクエストエラー: {e!r}")
+                return []
         self.logger.info(f"合計 {len(symbols)} の取引可能なLinear銘柄を発見")
         return symbols
 
-    async def get_kline_data(self, session: aiohttp.ClientSession, symbol: str, interval: str, limit: int = 5) -> Optional[List[List[Any]]]:
+    async def get_kline_data(self, session: aiohttp.ClientSession, symbol: str, interval: str, limit: int = 5,
+                             start: Optional[int] = None, end: Optional[int] = None) -> Optional[List[List[Any]]]:
+        """
+        K線データを取得する。start/end (ミリ秒) を指定した場合は、その範囲の足だけを取得する。
+        再試行で回復し得るエラー (タイムアウト、レートリミット、サーバーエラー) は FetchError を送出し、
+        それ以外のエラーはログに残して None を返す。
+        """
+        url = f"{self.base_url}/v5/market/kline"
+        breaker = self.get_breaker(url)
         params = {"category": "linear", "symbol": symbol, "interval": interval, "limit": limit}
+        if start is not None:
+            params["start"] = start
+        if end is not None:
+            params["end"] = end
+        breaker.before_request()
         try:
-            async with session.get(f"{self.base_url}/v5/market/kline", params=params) as response:
+            request_start = time.perf_counter_ns()
+            async with session.get(url, params=params) as response:
+                if response.status in RETRYABLE_HTTP_STATUSES:
+                    self._record_failure(breaker)
+                    raise FetchError(f"HTTP {response.status}", retry_after=self._retry_after(response))
                 response.raise_for_status()
+                # 本文を受信し終えてからパースし、通信時間とパース時間を分けて計測できるようにする
+                await response.read()
+                parse_start = time.perf_counter_ns()
                 data = await response.json()
-                if data.get("retCode") == 0:
+                ret_code = data.get("retCode")
+                if ret_code == 0:
+                    self._record_success(breaker)
                     result_list = [[int(i[0]), float(i[1]), float(i[2]), float(i[3]), float(i[4]), float(i[5]), float(i[6])] for i in data.get("result", {}).get("list", [])]
+                    if self.profiler:
+                        self.profiler.add("http", parse_start - request_start)
+                        self.profiler.add("parse", time.perf_counter_ns() - parse_start)
                     return result_list
+                elif ret_code in RETRYABLE_RET_CODES:
+                    self._record_failure(breaker)
+                    raise FetchError(f"APIエラー ({ret_code}): {data.get('retMsg')}", retry_after=self._retry_after(response))
                 else:
+                    self._record_success(breaker)
                     self.logger.warning(f"{symbol} ({interval}) K線取得APIエラー: {data.get('retMsg')}")
                     return None
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            self._record_failure(breaker)
+            raise FetchError(f"通信エラー: {e!r}") from e
         except (aiohttp.ClientError, ValueError, TypeError, KeyError) as e:
+            self._record_success(breaker)
             self.logger.warning(f"{symbol} ({interval}) K線取得リクエスト/パースエラー: {e}")
             return None
@@ -9,12 +9,23 @@ from dotenv import load_dotenv
 LOG_DIR = Path("/app/logs")
 DATA_DIR = Path("/app/data")
 DB_FILE = DATA_DIR / "cmma.db"
+SNAPSHOT_DIR = DATA_DIR / "snapshots"
+PROFILE_DIR = LOG_DIR / "profiles"
 
 TIMEFRAME_MAP = {
     "1m": "1", "5m": "5", "15m": "15", "30m": "30",
     "1h": "60", "4h": "240", "1d": "D", "1w": "W", "1M": "M"
 }
 
+# 足の間隔 (ミリ秒)。1Mは月ごとに日数が異なるため、欠損検出の対象外とする
+TIMEFRAME_INTERVAL_MS = {
+    "1m": 60_000, "5m": 300_000, "15m": 900_000, "30m": 1_800_000,
+    "1h": 3_600_000, "4h": 14_400_000, "1d": 86_400_000, "1w": 604_800_000
+}
+
+# Bybitのkline APIで1リクエストに取得できる足の最大数
+KLINE_MAX_LIMIT = 1000
+
 class AppConfig:
     def __init__(self, dotenv_path=None):
         if dotenv_path:
@@ -25,6 +36,29 @@ class AppConfig:
         self.concurrency_limit = int(os.getenv("CONCURRENCY_LIMIT", "10"))
         self.fetch_interval_seconds = int(os.getenv("FETCH_INTERVAL_SECONDS", "300"))
         self.ohlcv_history_limit = int(os.getenv("OHLCV_HISTORY_LIMIT", "5"))
+        # 通常のサイクルで取得する最新の足の本数 (未指定ならOHLCV_HISTORY_LIMIT分を毎回取得する)
+        self.fetch_limit = int(os.getenv("FETCH_LIMIT", str(self.ohlcv_history_limit)))
+        self.storage_format = os.getenv("STORAGE_FORMAT", "legacy")
+        self.price_scale_decimals = int(os.getenv("PRICE_SCALE_DECIMALS", "0"))
+        self.change_log_retention = int(os.getenv("CHANGE_LOG_RETENTION", "1000000"))
+        # 失敗した (timeframe, symbol) の再試行設定
+        self.retry_max_attempts = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+        self.retry_base_delay_seconds = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "0.5"))
+        self.retry_max_delay_seconds = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "15"))
+        self.retry_budget_per_cycle = int(os.getenv("RETRY_BUDGET_PER_CYCLE", "500"))
+        self.retry_deadline_seconds = float(os.getenv("RETRY_DEADLINE_SECONDS", "120"))
+        self.circuit_failure_threshold = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "20"))
+        self.circuit_cooldown_seconds = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "30"))
+        # 欠損した足の範囲補完 (1サイクルあたりのリクエスト上限。0で無効)
+        self.gap_repair_budget_per_cycle = int(os.getenv("GAP_REPAIR_BUDGET_PER_CYCLE", "100"))
+        self.gap_repair_concurrency = int(os.getenv("GAP_REPAIR_CONCURRENCY", "2"))
+        # 補完の開始から何秒までを補完に使うか (再試行の期限とは別に数える)
+        self.gap_repair_deadline_seconds = float(os.getenv("GAP_REPAIR_DEADLINE_SECONDS", "60"))
+        # API向けの共有スナップショット (mmap用バイナリファイル) を書き出すか
+        self.snapshot_enabled = os.getenv("SNAPSHOT_ENABLED", "false").lower() == "true"
+        # データ取得サイクルごとのプロファイル (cProfile + 区間計測) を書き出すか
+        self.profile_fetch_cycles = os.getenv("PROFILE_FETCH_CYCLES", "false").lower() == "true"
+        self.profile_retention = int(os.getenv("PROFILE_RETENTION", "50"))
         self.base_url = "https://api.bybit.com"
 
 def setup_logging(config: AppConfig) -> logging.Logger:
@@ -3,10 +3,12 @@ import sys
 import traceback
 from datetime import datetime
 
-from config import AppConfig, setup_logging, DB_FILE
+from config import AppConfig, setup_logging, DB_FILE, PROFILE_DIR, SNAPSHOT_DIR
 from client import BybitClient
-from repository import DatabaseRepository
+from repository import create_repository
 from service import DataFetchService
+from snapshot import SnapshotPublisher
+from profiling import CycleProfiler
 
 async def main():
     logger = None
@@ -21,13 +23,27 @@ async def main():
         logger = setup_logging(config)
 
         # 3. Repository
-        repo = DatabaseRepository(DB_FILE, config.timeframes, logger)
+        repo = create_repository(
+            config.storage_format, DB_FILE, config.timeframes, logger, config.price_scale_decimals
+        )
 
-        # 4. API Client
-        client = BybitClient(config.base_url, logger)
+        # 4. Profiler
+        profiler = None
+        if config.profile_fetch_cycles:
+            profiler = CycleProfiler(PROFILE_DIR, logger, config.profile_retention)
 
-        # 5. Service
-        service = DataFetchService(client, repo, config, logger)
+        # 5. API Client
+        client = BybitClient(
+            config.base_url, logger, config.circuit_failure_threshold, config.circuit_cooldown_seconds, profiler
+        )
+
+        # 6. Snapshot
+        publisher = None
+        if config.snapshot_enabled:
+            publisher = SnapshotPublisher(repo, SNAPSHOT_DIR, config.ohlcv_history_limit, logger)
+
+        # 7. Service
+        service = DataFetchService(client, repo, config, logger, publisher, profiler)
 
         while True:
             await service.fetch_and_store_data()
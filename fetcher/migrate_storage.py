@@ -0,0 +1,167 @@
+"""
+既存の ohlcv_{tf} テーブル (legacy) を、整数シンボルIDを使う compact レイアウトへ移行するツール。
+
+使い方 (fetcherコンテナ内):
+    python migrate_storage.py [--db /app/data/cmma.db] [--price-decimals 8] [--drop-legacy] [--vacuum]
+
+移行後は .env に STORAGE_FORMAT=compact を設定して fetcher と api を再起動する。
+"""
+import argparse
+import logging
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import List
+
+from config import DB_FILE
+from repository import CompactDatabaseRepository, STORAGE_FORMAT_COMPACT
+
+
+def find_legacy_timeframes(conn: sqlite3.Connection) -> List[str]:
+    """DB内の legacy レイアウトのテーブルからタイムフレーム一覧を取得する"""
+    rows = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'ohlcv\\_%' ESCAPE '\\'"
+    ).fetchall()
+    timeframes = []
+    for (name,) in rows:
+        tf = name[len("ohlcv_"):]
+        if not tf.endswith("_compact"):
+            timeframes.append(tf)
+    return sorted(timeframes)
+
+
+def get_legacy_last_change_seq(conn: sqlite3.Connection) -> int:
+    """legacy レイアウトの変更ログで最後に採番された seq (削除済みの分を含む) を取得する"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row[0] if row else 0
+
+
+def copy_legacy_change_log(conn: sqlite3.Connection, log_table: str, scale: int) -> int:
+    """
+    legacy の変更ログを、seq を保ったまま移行先の変更ログにコピーする。
+    移行前の時点で同期が遅れている /changes の利用者も、移行後に続きから取得できるようにするため。
+    """
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'change_log'").fetchone():
+        return 0
+    if scale > 1:
+        price = lambda col: f"CAST(ROUND(c.{col} * {scale}) AS INTEGER)"
+    else:
+        price = lambda col: f"c.{col}"
+    conn.execute("INSERT OR IGNORE INTO symbols (symbol) SELECT DISTINCT symbol FROM change_log")
+    return conn.execute(f"""
+    INSERT INTO {log_table} (seq, timeframe, op, symbol_id, timestamp, open, high, low, close, volume, turnover)
+    SELECT c.seq, c.timeframe, c.op, s.symbol_id, c.timestamp,
+           {price('open')}, {price('high')}, {price('low')}, {price('close')}, c.volume, c.turnover
+    FROM change_log c
+    INNER JOIN symbols s ON s.symbol = c.symbol
+    WHERE c.seq > (SELECT COALESCE(MAX(seq), 0) FROM {log_table})
+    ORDER BY c.seq
+    """).rowcount
+
+
+def continue_change_seq(conn: sqlite3.Connection, log_table: str, legacy_last_seq: int) -> int:
+    """
+    移行先の変更ログの seq を legacy の続きから採番させる。
+    移行時のINSERTでトリガーが採番した分 (削除済み) は数えず、実際に残っている変更の最大値に合わせる。
+    """
+    last_seq = conn.execute(
+        f"SELECT MAX(?, COALESCE(MAX(seq), 0)) FROM {log_table}", (legacy_last_seq,)
+    ).fetchone()[0]
+    updated = conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (last_seq, log_table)).rowcount
+    if not updated:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (log_table, last_seq))
+    return last_seq
+
+
+def migrate(db_file: Path, price_scale_decimals: int, drop_legacy: bool, vacuum: bool, logger: logging.Logger):
+    with sqlite3.connect(db_file) as probe:
+        timeframes = find_legacy_timeframes(probe)
+        legacy_last_seq = get_legacy_last_change_seq(probe)
+    if not timeframes:
+        logger.info("移行対象の legacy テーブルがありません。")
+        return
+
+    logger.info(f"移行対象のタイムフレーム: {timeframes}")
+    repo = CompactDatabaseRepository(db_file, timeframes, logger, price_scale_decimals)
+    scale = 10 ** repo.price_scale_decimals
+    conn = repo.conn
+    try:
+        for tf in timeframes:
+            start = time.time()
+            legacy_table = f"ohlcv_{tf}"
+            compact_table = repo.get_table_name(tf)
+            if repo.price_scale_decimals > 0:
+                price = lambda col: f"CAST(ROUND(l.{col} * {scale}) AS INTEGER)"
+            else:
+                price = lambda col: f"l.{col}"
+
+            log_table = repo.get_change_log_table()
+            last_seq = conn.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {log_table}").fetchone()[0]
+
+            conn.execute(f"INSERT OR IGNORE INTO symbols (symbol) SELECT DISTINCT symbol FROM {legacy_table}")
+            # 主キー順に挿入することで、WITHOUT ROWIDテーブルのページ分割を抑える
+            conn.execute(f"""
+            INSERT OR REPLACE INTO {compact_table} (symbol_id, timestamp, open, high, low, close, volume, turnover)
+            SELECT s.symbol_id, l.timestamp, {price('open')}, {price('high')}, {price('low')}, {price('close')},
+                   l.volume, l.turnover
+            FROM {legacy_table} l
+            INNER JOIN symbols s ON s.symbol = l.symbol
+            ORDER BY s.symbol_id, l.timestamp
+            """)
+            legacy_count = conn.execute(f"SELECT COUNT(*) FROM {legacy_table}").fetchone()[0]
+            compact_count = conn.execute(f"SELECT COUNT(*) FROM {compact_table}").fetchone()[0]
+            if compact_count < legacy_count:
+                raise RuntimeError(
+                    f"[{tf}] 行数が一致しません (legacy: {legacy_count}, compact: {compact_count})"
+                )
+            # 移行によるINSERTは実データの変更ではないため、変更ログから除外する
+            conn.execute(f"DELETE FROM {log_table} WHERE seq > ?", (last_seq,))
+            if drop_legacy:
+                conn.execute(f"DROP TABLE {legacy_table}")
+            conn.commit()
+            logger.info(f"[{tf}] {legacy_count} 件を '{compact_table}' に移行しました ({time.time() - start:.2f}秒)")
+
+        log_table = repo.get_change_log_table()
+        copied = copy_legacy_change_log(conn, log_table, scale)
+        last_seq = continue_change_seq(conn, log_table, legacy_last_seq)
+        conn.commit()
+        logger.info(f"変更ログ {copied} 件を '{log_table}' にコピーしました (次のseq: {last_seq + 1})")
+    except (sqlite3.Error, RuntimeError):
+        conn.rollback()
+        raise
+    finally:
+        repo.close()
+
+    if vacuum:
+        logger.info("VACUUMを実行中...")
+        with sqlite3.connect(db_file) as vac_conn:
+            vac_conn.execute("VACUUM")
+    logger.info(f"移行が完了しました。STORAGE_FORMAT={STORAGE_FORMAT_COMPACT} を設定して再起動してください。")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="cmma.db を compact レイアウトへ移行します")
+    parser.add_argument("--db", type=Path, default=DB_FILE, help="対象のDBファイル")
+    parser.add_argument("--price-decimals", type=int, default=0,
+                        help="価格を整数で保存する際の小数桁数 (0の場合はREALのまま)")
+    parser.add_argument("--drop-legacy", action="store_true", help="移行後に legacy テーブルを削除する")
+    parser.add_argument("--vacuum", action="store_true", help="移行後にVACUUMでファイルサイズを縮小する")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s",
+                        datefmt="%Y-%m-%d %H:%M:%S")
+    logger = logging.getLogger("StorageMigration")
+    if not args.db.exists():
+        logger.error(f"DBファイルが見つかりません: {args.db}")
+        return 1
+    try:
+        migrate(args.db, args.price_decimals, args.drop_legacy, args.vacuum, logger)
+    except (sqlite3.Error, RuntimeError) as e:
+        logger.error(f"移行に失敗しました: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
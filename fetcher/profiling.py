@@ -0,0 +1,147 @@
+"""
+データ取得サイクルのプロファイリング (PROFILE_FETCH_CYCLES=true の場合のみ有効)。
+
+1サイクルごとに次の2ファイルを書き出す。
+    cycle_{日時}.prof        cProfileの結果 (pstats形式。snakeviz や `python -m pstats` で開ける)
+    cycle_{日時}.trace.json  区間ごとの処理時間とイベントループの遅延 (Chrome Trace Event形式。
+                             Perfetto / chrome://tracing / speedscope で開ける)
+
+区間は span() で計測し、入れ子にできる。多数の並行タスクで発生する短い処理 (レスポンスのパースなど) は
+add() で件数と合計時間だけを集計し、その時点で実行中の区間の内訳として記録する。
+"""
+import asyncio
+import contextvars
+import cProfile
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# イベントループの遅延を計測する間隔 (秒)
+LOOP_LAG_INTERVAL_SECONDS = 0.05
+
+_current_span: contextvars.ContextVar[str] = contextvars.ContextVar("current_span", default="")
+
+
+class CycleProfiler:
+    """データ取得サイクル1回分の区間計測、cProfile、イベントループ遅延の記録"""
+
+    def __init__(self, output_dir: Path, logger: logging.Logger, retention: int = 50):
+        self.output_dir = output_dir
+        self.logger = logger
+        self.retention = retention
+        self._reset()
+
+    def _reset(self):
+        self.started_ns = time.perf_counter_ns()
+        # (区間名, 開始ns, 終了ns)
+        self.spans: List[Tuple[str, int, int]] = []
+        # 区間名 -> 集計名 -> [件数, 合計ns]
+        self.aggregates: Dict[str, Dict[str, List[int]]] = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+        # (計測時刻ns, 遅延ms)
+        self.loop_lag: List[Tuple[int, float]] = []
+        self._profile: Optional[cProfile.Profile] = None
+        self._lag_task: Optional[asyncio.Task] = None
+
+    def begin(self):
+        """サイクルの開始時に (イベントループ上で) 呼び出す"""
+        self._reset()
+        self._lag_task = asyncio.create_task(self._monitor_loop_lag())
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    async def finish(self):
+        """サイクルの終了時に呼び出し、プロファイルを書き出す"""
+        self._profile.disable()
+        self._lag_task.cancel()
+        try:
+            await self._lag_task
+        except asyncio.CancelledError:
+            pass
+        total_ms = (time.perf_counter_ns() - self.started_ns) / 1e6
+
+        name = f"cycle_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            self._profile.dump_stats(str(self.output_dir / f"{name}.prof"))
+            with open(self.output_dir / f"{name}.trace.json", "w", encoding="utf-8") as f:
+                json.dump(self.to_chrome_trace(total_ms), f)
+            self._prune_old_profiles()
+        except OSError as e:
+            self.logger.error(f"プロファイルの書き出し中にエラー: {e}")
+            return
+        self.logger.info(f"プロファイルを書き出しました: {self.output_dir / name}.(prof|trace.json)\n{self.summary(total_ms)}")
+
+    @contextmanager
+    def span(self, name: str):
+        """区間の処理時間を記録する"""
+        token = _current_span.set(name)
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start_ns, time.perf_counter_ns()))
+            _current_span.reset(token)
+
+    def add(self, name: str, elapsed_ns: int):
+        """実行中の区間の内訳として、件数と合計時間を集計する"""
+        entry = self.aggregates[_current_span.get()][name]
+        entry[0] += 1
+        entry[1] += elapsed_ns
+
+    async def _monitor_loop_lag(self):
+        """一定間隔でスリープし、予定より遅れて再開した時間をイベントループの遅延として記録する"""
+        while True:
+            expected_ns = time.perf_counter_ns() + int(LOOP_LAG_INTERVAL_SECONDS * 1e9)
+            await asyncio.sleep(LOOP_LAG_INTERVAL_SECONDS)
+            now_ns = time.perf_counter_ns()
+            self.loop_lag.append((now_ns, max(0, now_ns - expected_ns) / 1e6))
+
+    def to_chrome_trace(self, total_ms: float) -> dict:
+        """Chrome Trace Event形式 (タイムスタンプはマイクロ秒)"""
+        def us(ns: int) -> float:
+            return (ns - self.started_ns) / 1000
+
+        events = [{"name": "process_name", "ph": "M", "pid": 1, "tid": 1, "args": {"name": "fetch_and_store_data"}}]
+        for name, start_ns, end_ns in sorted(self.spans, key=lambda s: (s[0] != "cycle", s[1], -s[2])):
+            args = {
+                agg_name: {"count": count, "total_ms": round(total_ns / 1e6, 3)}
+                for agg_name, (count, total_ns) in self.aggregates.get(name, {}).items()
+            }
+            events.append({
+                "name": name, "cat": "cycle", "ph": "X", "pid": 1, "tid": 1,
+                "ts": us(start_ns), "dur": (end_ns - start_ns) / 1000, "args": args,
+            })
+        for ts_ns, lag_ms in self.loop_lag:
+            events.append({"name": "event_loop_lag_ms", "ph": "C", "pid": 1, "tid": 1, "ts": us(ts_ns), "args": {"lag": lag_ms}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"total_ms": total_ms}}
+
+    def summary(self, total_ms: float) -> str:
+        lines = [f"  合計: {total_ms:.1f}ms"]
+        for name, start_ns, end_ns in sorted(self.spans, key=lambda s: s[1]):
+            if name == "cycle":
+                continue
+            line = f"  {name}: {(end_ns - start_ns) / 1e6:.1f}ms"
+            details = [
+                f"{agg_name} {count}件 {total_ns / 1e6:.1f}ms"
+                for agg_name, (count, total_ns) in self.aggregates.get(name, {}).items()
+            ]
+            if details:
+                line += f" ({', '.join(details)})"
+            lines.append(line)
+        if self.loop_lag:
+            lags = sorted(lag for _, lag in self.loop_lag)
+            p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))]
+            lines.append(f"  イベントループの遅延: 最大 {lags[-1]:.1f}ms, p99 {p99:.1f}ms ({len(lags)} サンプル)")
+        return "\n".join(lines)
+
+    def _prune_old_profiles(self):
+        """保持数を超えた古いプロファイルを削除する"""
+        profiles = sorted(self.output_dir.glob("cycle_*.prof"))
+        for prof in profiles[:max(0, len(profiles) - self.retention)]:
+            prof.unlink(missing_ok=True)
+            prof.with_name(prof.stem + ".trace.json").unlink(missing_ok=True)
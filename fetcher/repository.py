@@ -2,9 +2,20 @@ import sqlite3
 import logging
 import sys
 from pathlib import Path
-from typing import List, Tuple, Set
+from typing import Dict, List, Tuple, Set
+
+STORAGE_FORMAT_LEGACY = "legacy"
+STORAGE_FORMAT_COMPACT = "compact"
 
 class DatabaseRepository:
+    # 値が変わっていない行は更新しない (WAL/ページの書き換えと変更ログへの記録を避ける)
+    CHANGED_ONLY_CLAUSE = """WHERE open != excluded.open
+                OR high != excluded.high
+                OR low != excluded.low
+                OR close != excluded.close
+                OR volume != excluded.volume
+                OR turnover != excluded.turnover"""
+
     def __init__(self, db_file: Path, timeframes: List[str], logger: logging.Logger):
         self.db_file = db_file
         self.timeframes = timeframes
@@ -18,6 +29,7 @@ class DatabaseRepository:
             conn = sqlite3.connect(self.db_file, timeout=10)
             cursor = conn.cursor()
             self.logger.info(f"データベースに接続: {self.db_file}")
+            self._create_change_log(cursor, "symbol TEXT NOT NULL", "REAL")
 
             for tf in self.timeframes:
                 tf_clean = tf.strip()
@@ -37,6 +49,7 @@ class DatabaseRepository:
                     PRIMARY KEY (symbol, timestamp)
                 )
                 """)
+                self._create_change_triggers(cursor, tf_clean, "symbol")
             conn.commit()
             self.logger.info("全テーブルの準備完了。")
             return conn
@@ -47,6 +60,106 @@ class DatabaseRepository:
     def get_table_name(self, timeframe: str) -> str:
         return f"ohlcv_{timeframe}"
 
+    def get_change_log_table(self) -> str:
+        return "change_log"
+
+    def find_gaps(self, timeframe: str, interval_ms: int) -> List[Tuple[str, int, int]]:
+        """
+        銘柄ごとに、隣り合う足の間隔が interval_ms を超えている箇所を (symbol, 直前の足, 直後の足) で返す。
+        主キー (symbol, timestamp) の順序を使い、テーブルを1回走査するだけで全銘柄を検査する。
+        """
+        table_name = self.get_table_name(timeframe)
+        gap_sql = f"""
+        SELECT symbol, prev_ts, timestamp FROM (
+            SELECT
+                symbol,
+                timestamp,
+                LAG(timestamp) OVER (PARTITION BY symbol ORDER BY timestamp) AS prev_ts
+            FROM {table_name}
+        )
+        WHERE timestamp - prev_ts > ?
+        """
+        try:
+            return self.conn.execute(gap_sql, (interval_ms,)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(f"[{timeframe}] 欠損の検出中にエラー: {e}")
+            return []
+
+    def get_latest_change_seq(self) -> int:
+        """
+        変更ログで最後に採番されたシーケンス番号 (スナップショットの世代番号として使う)。
+        prune_change_log でログが空になっても減らないよう、sqlite_sequence から取得する。
+        """
+        row = self.conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = ?", (self.get_change_log_table(),)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def fetch_snapshot_rows(self, timeframe: str, depth: int) -> List[Tuple]:
+        """
+        スナップショット用に、銘柄ごとの新しい順 depth 本の足を
+        (symbol, 新しい順の位置, timestamp, close, volume, turnover) で銘柄名順に返す。
+        """
+        table_name = self.get_table_name(timeframe)
+        return self.conn.execute(f"""
+        SELECT symbol, pos, timestamp, close, volume, turnover FROM (
+            SELECT
+                symbol, timestamp, close, volume, turnover,
+                ROW_NUMBER() OVER (PARTITION BY symbol ORDER BY timestamp DESC) - 1 AS pos
+            FROM {table_name}
+        )
+        WHERE pos < ?
+        ORDER BY symbol, pos
+        """, (depth,)).fetchall()
+
+    def load_known_symbols(self) -> List[str]:
+        """DBに保存済みの銘柄一覧を取得する (銘柄一覧APIが失敗した場合のフォールバック用)"""
+        symbols: Set[str] = set()
+        try:
+            for tf in self.timeframes:
+                tf_clean = tf.strip()
+                if not tf_clean: continue
+                rows = self.conn.execute(f"SELECT DISTINCT symbol FROM {self.get_table_name(tf_clean)}").fetchall()
+                symbols.update(row[0] for row in rows)
+        except sqlite3.Error as e:
+            self.logger.error(f"保存済み銘柄の取得中にエラー: {e}")
+        return sorted(symbols)
+
+    def _create_change_log(self, cursor: sqlite3.Cursor, key_column_def: str, price_type: str):
+        """
+        実際に挿入・更新された足だけを記録する変更ログテーブルを作成する。
+        seq は AUTOINCREMENT なので、古いログを削除しても再利用されず単調増加する。
+        """
+        cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {self.get_change_log_table()} (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            timeframe TEXT NOT NULL,
+            op TEXT NOT NULL,
+            {key_column_def},
+            timestamp INTEGER NOT NULL,
+            open {price_type} NOT NULL,
+            high {price_type} NOT NULL,
+            low {price_type} NOT NULL,
+            close {price_type} NOT NULL,
+            volume REAL NOT NULL,
+            turnover REAL NOT NULL
+        )
+        """)
+
+    def _create_change_triggers(self, cursor: sqlite3.Cursor, timeframe: str, key_column: str):
+        """OHLCVテーブルへのINSERT/UPDATEを変更ログに書き込むトリガーを作成する"""
+        table_name = self.get_table_name(timeframe)
+        log_table = self.get_change_log_table()
+        for event, op in (("INSERT", "I"), ("UPDATE", "U")):
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS {table_name}_{event.lower()}_log AFTER {event} ON {table_name}
+            BEGIN
+                INSERT INTO {log_table} (timeframe, op, {key_column}, timestamp, open, high, low, close, volume, turnover)
+                VALUES ('{timeframe}', '{op}', NEW.{key_column}, NEW.timestamp, NEW.open, NEW.high, NEW.low,
+                        NEW.close, NEW.volume, NEW.turnover);
+            END
+            """)
+
     def upsert_ohlcv_data(self, timeframe: str, records: List[Tuple]):
         if not records:
             return
@@ -65,10 +178,12 @@ class DatabaseRepository:
                 close=excluded.close,
                 volume=excluded.volume,
                 turnover=excluded.turnover
+            {self.CHANGED_ONLY_CLAUSE}
             """
             cursor.executemany(upsert_sql, records)
+            changed = cursor.rowcount
             self.conn.commit()
-            self.logger.info(f"[{timeframe}] UPSERTが完了しました。")
+            self.logger.info(f"[{timeframe}] UPSERTが完了しました。(変更 {changed} 件 / {len(records)} 件)")
         except sqlite3.Error as e:
             self.logger.error(f"[{timeframe}] DB保存中にエラー: {e}")
             self.conn.rollback()
@@ -97,7 +212,235 @@ class DatabaseRepository:
             self.logger.error(f"[{timeframe}] DBクリーンアップ中にエラー: {e}")
             self.conn.rollback()
 
+    def prune_change_log(self, retention: int):
+        """変更ログを直近 retention 件だけ残して削除する"""
+        log_table = self.get_change_log_table()
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(
+                f"DELETE FROM {log_table} WHERE seq <= (SELECT MAX(seq) FROM {log_table}) - ?",
+                (retention,)
+            )
+            deleted = cursor.rowcount
+            self.conn.commit()
+            if deleted:
+                self.logger.info(f"変更ログ '{log_table}' から古い {deleted} 件を削除しました。")
+        except sqlite3.Error as e:
+            self.logger.error(f"変更ログのクリーンアップ中にエラー: {e}")
+            self.conn.rollback()
+
     def close(self):
         if self.conn:
             self.conn.close()
             self.logger.info("データベース接続をクローズしました。")
+
+
+class CompactDatabaseRepository(DatabaseRepository):
+    """
+    シンボルを辞書テーブル (symbols) の整数IDに置き換えたレイアウト。
+    各タイムフレームのテーブルは (symbol_id, timestamp) でクラスタ化された WITHOUT ROWID テーブルで、
+    price_scale_decimals > 0 の場合は価格 (open/high/low/close) を 10^decimals 倍した整数で保存する。
+    """
+
+    def __init__(self, db_file: Path, timeframes: List[str], logger: logging.Logger, price_scale_decimals: int = 0):
+        self.price_scale_decimals = price_scale_decimals
+        self._symbol_ids: Dict[str, int] = {}
+        super().__init__(db_file, timeframes, logger)
+
+    def _setup_database(self) -> sqlite3.Connection:
+        """辞書テーブル・メタデータテーブルと、タイムフレームごとのテーブルを作成する"""
+        try:
+            self.db_file.parent.mkdir(exist_ok=True)
+            conn = sqlite3.connect(self.db_file, timeout=10)
+            cursor = conn.cursor()
+            self.logger.info(f"データベースに接続 (compact): {self.db_file}")
+
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS symbols (
+                symbol_id INTEGER PRIMARY KEY,
+                symbol TEXT NOT NULL UNIQUE
+            )
+            """)
+            cursor.execute("""
+            CREATE TABLE IF NOT EXISTS storage_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            )
+            """)
+
+            # 既存データと異なる倍率で書き込むと値が壊れるため、保存済みの倍率を優先する
+            row = cursor.execute("SELECT value FROM storage_meta WHERE key = 'price_scale_decimals'").fetchone()
+            if row is None:
+                cursor.execute(
+                    "INSERT INTO storage_meta (key, value) VALUES ('price_scale_decimals', ?)",
+                    (str(self.price_scale_decimals),)
+                )
+            elif int(row[0]) != self.price_scale_decimals:
+                self.logger.warning(
+                    f"PRICE_SCALE_DECIMALS={self.price_scale_decimals} は既存DBの設定 ({row[0]}) と異なるため、既存の設定を使用します。"
+                )
+                self.price_scale_decimals = int(row[0])
+
+            price_type = "INTEGER" if self.price_scale_decimals > 0 else "REAL"
+            self._create_change_log(cursor, "symbol_id INTEGER NOT NULL", price_type)
+            for tf in self.timeframes:
+                tf_clean = tf.strip()
+                if not tf_clean: continue
+                table_name = self.get_table_name(tf_clean)
+                self.logger.info(f"テーブル '{table_name}' の準備中...")
+                cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    symbol_id INTEGER NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    open {price_type} NOT NULL,
+                    high {price_type} NOT NULL,
+                    low {price_type} NOT NULL,
+                    close {price_type} NOT NULL,
+                    volume REAL NOT NULL,
+                    turnover REAL NOT NULL,
+                    PRIMARY KEY (symbol_id, timestamp)
+                ) WITHOUT ROWID
+                """)
+                self._create_change_triggers(cursor, tf_clean, "symbol_id")
+            conn.commit()
+
+            self._symbol_ids = dict(cursor.execute("SELECT symbol, symbol_id FROM symbols").fetchall())
+            self.logger.info("全テーブルの準備完了。")
+            return conn
+        except sqlite3.Error as e:
+            self.logger.error(f"データベースのセットアップに失敗: {e}")
+            sys.exit(1)
+
+    def get_table_name(self, timeframe: str) -> str:
+        return f"ohlcv_{timeframe}_compact"
+
+    def get_change_log_table(self) -> str:
+        return "change_log_compact"
+
+    def find_gaps(self, timeframe: str, interval_ms: int) -> List[Tuple[str, int, int]]:
+        table_name = self.get_table_name(timeframe)
+        gap_sql = f"""
+        SELECT s.symbol, g.prev_ts, g.timestamp FROM (
+            SELECT
+                symbol_id,
+                timestamp,
+                LAG(timestamp) OVER (PARTITION BY symbol_id ORDER BY timestamp) AS prev_ts
+            FROM {table_name}
+        ) g
+        INNER JOIN symbols s ON s.symbol_id = g.symbol_id
+        WHERE g.timestamp - g.prev_ts > ?
+        """
+        try:
+            return self.conn.execute(gap_sql, (interval_ms,)).fetchall()
+        except sqlite3.Error as e:
+            self.logger.error(f"[{timeframe}] 欠損の検出中にエラー: {e}")
+            return []
+
+    def fetch_snapshot_rows(self, timeframe: str, depth: int) -> List[Tuple]:
+        table_name = self.get_table_name(timeframe)
+        return self.conn.execute(f"""
+        SELECT s.symbol, r.pos, r.timestamp, r.close * 1.0 / ?, r.volume, r.turnover FROM (
+            SELECT
+                symbol_id, timestamp, close, volume, turnover,
+                ROW_NUMBER() OVER (PARTITION BY symbol_id ORDER BY timestamp DESC) - 1 AS pos
+            FROM {table_name}
+        ) r
+        INNER JOIN symbols s ON s.symbol_id = r.symbol_id
+        WHERE r.pos < ?
+        ORDER BY s.symbol, r.pos
+        """, (10 ** self.price_scale_decimals, depth)).fetchall()
+
+    def load_known_symbols(self) -> List[str]:
+        try:
+            return [row[0] for row in self.conn.execute("SELECT symbol FROM symbols ORDER BY symbol").fetchall()]
+        except sqlite3.Error as e:
+            self.logger.error(f"保存済み銘柄の取得中にエラー: {e}")
+            return []
+
+    def _get_symbol_ids(self, symbols: Set[str]) -> Dict[str, int]:
+        """未登録のシンボルを辞書テーブルに追加し、シンボル→IDの対応を返す"""
+        missing = [s for s in symbols if s not in self._symbol_ids]
+        if missing:
+            cursor = self.conn.cursor()
+            cursor.executemany("INSERT OR IGNORE INTO symbols (symbol) VALUES (?)", [(s,) for s in missing])
+            placeholders = ",".join("?" * len(missing))
+            cursor.execute(f"SELECT symbol, symbol_id FROM symbols WHERE symbol IN ({placeholders})", missing)
+            self._symbol_ids.update(cursor.fetchall())
+        return self._symbol_ids
+
+    def _encode_price(self, price: float):
+        if self.price_scale_decimals > 0:
+            return int(round(price * 10 ** self.price_scale_decimals))
+        return price
+
+    def upsert_ohlcv_data(self, timeframe: str, records: List[Tuple]):
+        if not records:
+            return
+
+        table_name = self.get_table_name(timeframe)
+        self.logger.info(f"[{timeframe}] {len(records)} 件のレコードをテーブル '{table_name}' にUPSERTします...")
+        cursor = self.conn.cursor()
+        try:
+            symbol_ids = self._get_symbol_ids({rec[0] for rec in records})
+            enc = self._encode_price
+            rows = [
+                (symbol_ids[rec[0]], rec[1], enc(rec[2]), enc(rec[3]), enc(rec[4]), enc(rec[5]), rec[6], rec[7])
+                for rec in records
+            ]
+            upsert_sql = f"""
+            INSERT INTO {table_name} (symbol_id, timestamp, open, high, low, close, volume, turnover)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(symbol_id, timestamp) DO UPDATE SET
+                open=excluded.open,
+                high=excluded.high,
+                low=excluded.low,
+                close=excluded.close,
+                volume=excluded.volume,
+                turnover=excluded.turnover
+            {self.CHANGED_ONLY_CLAUSE}
+            """
+            cursor.executemany(upsert_sql, rows)
+            changed = cursor.rowcount
+            self.conn.commit()
+            self.logger.info(f"[{timeframe}] UPSERTが完了しました。(変更 {changed} 件 / {len(records)} 件)")
+        except sqlite3.Error as e:
+            self.logger.error(f"[{timeframe}] DB保存中にエラー: {e}")
+            self.conn.rollback()
+            # ロールバックで取り消された辞書登録をキャッシュに残さない
+            self._symbol_ids = dict(self.conn.execute("SELECT symbol, symbol_id FROM symbols").fetchall())
+
+    def cleanup_old_ohlcv_data(self, timeframe: str, symbols: Set[str], history_limit: int):
+        if not symbols:
+            return
+
+        table_name = self.get_table_name(timeframe)
+        self.logger.info(f"[{timeframe}] テーブル '{table_name}' の古いデータをクリーンアップします...")
+        cursor = self.conn.cursor()
+        try:
+            # WITHOUT ROWIDテーブルなので、保持する最古の足のタイムスタンプより前を範囲削除する
+            delete_sql = f"""
+            DELETE FROM {table_name}
+            WHERE symbol_id = :symbol_id AND timestamp < (
+                SELECT timestamp FROM {table_name}
+                WHERE symbol_id = :symbol_id
+                ORDER BY timestamp DESC
+                LIMIT 1 OFFSET {max(history_limit - 1, 0)}
+            )
+            """
+            symbol_ids = self._get_symbol_ids(symbols)
+            cursor.executemany(delete_sql, [{"symbol_id": symbol_ids[s]} for s in symbols])
+            self.conn.commit()
+            self.logger.info(f"[{timeframe}] クリーンアップが完了しました。")
+        except sqlite3.Error as e:
+            self.logger.error(f"[{timeframe}] DBクリーンアップ中にエラー: {e}")
+            self.conn.rollback()
+
+
+def create_repository(storage_format: str, db_file: Path, timeframes: List[str], logger: logging.Logger,
+                      price_scale_decimals: int = 0) -> DatabaseRepository:
+    """STORAGE_FORMAT に応じたリポジトリを生成する"""
+    if storage_format == STORAGE_FORMAT_COMPACT:
+        return CompactDatabaseRepository(db_file, timeframes, logger, price_scale_decimals)
+    if storage_format != STORAGE_FORMAT_LEGACY:
+        raise ValueError(f"未対応のSTORAGE_FORMATです: {storage_format}")
+    return DatabaseRepository(db_file, timeframes, logger)
@@ -0,0 +1,125 @@
+import heapq
+import itertools
+import random
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+class FetchError(Exception):
+    """再試行すれば成功する可能性のある取得エラー (タイムアウト、レートリミット、サーバーエラーなど)"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(FetchError):
+    """サーキットブレーカーが開いているため、リクエストを送らずに失敗させたことを表す"""
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, retry_after: Optional[float] = None) -> float:
+    """
+    ジッター付き指数バックオフ (full jitter) の待機秒数を返す。
+    サーバーから再試行可能時刻が示されている場合は、それより前には再試行しない。
+    """
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+class CircuitBreaker:
+    """
+    ホスト単位のサーキットブレーカー。
+    連続失敗が閾値に達すると一定時間 (cooldown) リクエストを遮断し、その後1件だけ試行 (half-open) して復旧を確認する。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, host: str, failure_threshold: int, cooldown_seconds: float):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def remaining_cooldown(self) -> float:
+        """遮断中であれば、次に試行できるまでの秒数を返す (遮断していなければ0)"""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.opened_at + self.cooldown_seconds - time.monotonic())
+
+    def before_request(self):
+        """リクエスト前に呼び出す。遮断中であれば CircuitOpenError を送出する"""
+        if self.state == self.OPEN:
+            remaining = self.remaining_cooldown()
+            if remaining > 0:
+                raise CircuitOpenError(f"{self.host} へのリクエストを遮断中 (残り {remaining:.1f}秒)", retry_after=remaining)
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                raise CircuitOpenError(f"{self.host} の復旧確認中", retry_after=1.0)
+            self._probe_in_flight = True
+
+    def record_success(self) -> bool:
+        """成功を記録する。遮断状態から復旧した場合は True を返す"""
+        recovered = self.state != self.CLOSED
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+        return recovered
+
+    def record_failure(self) -> bool:
+        """失敗を記録する。この失敗で遮断状態に移行した場合は True を返す"""
+        self._probe_in_flight = False
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            opened = self.state != self.OPEN
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            return opened
+        return False
+
+
+@dataclass(order=True)
+class RetryJob:
+    ready_at: float
+    seq: int
+    timeframe: str = field(compare=False)
+    symbol: str = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+    last_error: str = field(default="", compare=False)
+
+
+class RetryQueue:
+    """再試行可能時刻の早い順に (timeframe, symbol) のジョブを取り出す優先度付きキュー"""
+
+    def __init__(self):
+        self._heap: List[RetryJob] = []
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def push(self, timeframe: str, symbol: str, attempts: int, delay: float, last_error: str = ""):
+        job = RetryJob(time.monotonic() + delay, next(self._counter), timeframe, symbol, attempts, last_error)
+        heapq.heappush(self._heap, job)
+
+    def next_delay(self) -> float:
+        """先頭のジョブが再試行可能になるまでの秒数"""
+        if not self._heap:
+            return 0.0
+        return max(0.0, self._heap[0].ready_at - time.monotonic())
+
+    def pop(self) -> RetryJob:
+        return heapq.heappop(self._heap)
+
+    def drain(self) -> List[RetryJob]:
+        """残っているジョブを全て取り出す (サイクル終了時の集計用)"""
+        jobs, self._heap = self._heap, []
+        return jobs
@@ -1,32 +1,66 @@
 import asyncio
 import time
 import logging
+from collections import defaultdict
+from contextlib import nullcontext
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 import aiohttp
 
 from client import BybitClient
 from repository import DatabaseRepository
-from config import AppConfig, TIMEFRAME_MAP
+from config import AppConfig, KLINE_MAX_LIMIT, TIMEFRAME_INTERVAL_MS, TIMEFRAME_MAP
+from snapshot import SnapshotPublisher
+from profiling import CycleProfiler
+from retry import CircuitOpenError, FetchError, RetryJob, RetryQueue, backoff_delay
 
 class DataFetchService:
-    def __init__(self, client: BybitClient, repository: DatabaseRepository, config: AppConfig, logger: logging.Logger):
+    def __init__(self, client: BybitClient, repository: DatabaseRepository, config: AppConfig, logger: logging.Logger,
+                 snapshot_publisher: Optional[SnapshotPublisher] = None, profiler: Optional[CycleProfiler] = None):
         self.client = client
         self.repository = repository
         self.config = config
         self.logger = logger
+        self.snapshot_publisher = snapshot_publisher
+        self.profiler = profiler
+        # 銘柄一覧APIが失敗したときに使う、最後に取得できた銘柄一覧
+        self.last_symbols: List[str] = []
+        # 範囲取得しても足が返ってこなかった欠損 (取引停止期間など)。次回以降は補完を試みない
+        self.unfillable_gaps: Set[Tuple[str, str, int, int]] = set()
+
+    def _span(self, name: str):
+        """プロファイリングが有効な場合だけ区間を計測する"""
+        return self.profiler.span(name) if self.profiler else nullcontext()
 
     async def fetch_and_store_data(self):
+        if not self.profiler:
+            await self._run_cycle()
+            return
+
+        self.profiler.begin()
+        try:
+            with self.profiler.span("cycle"):
+                await self._run_cycle()
+        finally:
+            await self.profiler.finish()
+
+    async def _run_cycle(self):
         start_time = time.time()
         self.logger.info("====== 新しいデータ取得サイクルを開始 ======")
 
         async with aiohttp.ClientSession(timeout=self.client.timeout) as session:
-            symbols = await self.client.get_all_linear_symbols(session)
+            with self._span("symbols"):
+                symbols = await self._get_symbol_universe(session)
             if not symbols:
                 self.logger.error("銘柄が取得できず、データ取得をスキップします。")
                 return
 
             self.logger.info(f"対象タイムフレーム: {self.config.timeframes}")
 
+            retry_queue = RetryQueue()
+            retry_deadline = time.monotonic() + self.config.retry_deadline_seconds
+            sem = asyncio.Semaphore(self.config.concurrency_limit)
+
             for timeframe_str in self.config.timeframes:
                 timeframe_str = timeframe_str.strip()
                 if not timeframe_str: continue
@@ -38,30 +72,247 @@ class DataFetchService:
 
                 self.logger.info(f"--- タイムフレーム: {timeframe_str} ({interval}) のデータ取得を開始 ---")
 
-                sem = asyncio.Semaphore(self.config.concurrency_limit)
-
                 async def fetch_one(symbol: str):
                     async with sem:
-                        return await self.client.get_kline_data(session, symbol, interval, limit=self.config.ohlcv_history_limit)
+                        try:
+                            return await self.client.get_kline_data(session, symbol, interval, limit=self.config.fetch_limit)
+                        except FetchError as e:
+                            # 遮断中で送信しなかったリクエストは試行回数に数えない
+                            attempts = 0 if isinstance(e, CircuitOpenError) else 1
+                            delay = backoff_delay(0, self.config.retry_base_delay_seconds,
+                                                  self.config.retry_max_delay_seconds, e.retry_after)
+                            retry_queue.push(timeframe_str, symbol, attempts, delay, str(e))
+                            return None
+
+                with self._span(f"fetch {timeframe_str}"):
+                    tasks = [fetch_one(symbol) for symbol in symbols]
+                    results = await asyncio.gather(*tasks)
+                self._store(timeframe_str, zip(symbols, results))
 
-                tasks = [fetch_one(symbol) for symbol in symbols]
-                results = await asyncio.gather(*tasks)
+                self.logger.info(f"--- タイムフレーム: {timeframe_str} のデータ取得が完了 ---")
 
-                records_to_upsert = []
-                for symbol, ohlcv_data in zip(symbols, results):
-                    if ohlcv_data:
-                        for row in ohlcv_data:
-                            records_to_upsert.append((
-                                symbol, row[0], row[1], row[2], row[3], row[4], row[5], row[6]
-                            ))
+            if retry_queue:
+                with self._span("retry"):
+                    await self._retry_failed(session, retry_queue, retry_deadline)
 
-                if records_to_upsert:
-                    self.repository.upsert_ohlcv_data(timeframe_str, records_to_upsert)
+            if self.config.gap_repair_budget_per_cycle > 0:
+                with self._span("gap_repair"):
+                    await self._repair_gaps(session)
 
-                    upserted_symbols = {rec[0] for rec in records_to_upsert}
-                    self.repository.cleanup_old_ohlcv_data(timeframe_str, upserted_symbols, self.config.ohlcv_history_limit)
+            with self._span("prune_change_log"):
+                self.repository.prune_change_log(self.config.change_log_retention)
 
-                self.logger.info(f"--- タイムフレーム: {timeframe_str} のデータ取得が完了 ---")
+        if self.snapshot_publisher:
+            with self._span("snapshot"):
+                self.snapshot_publisher.publish(self.config.timeframes)
 
         end_time = time.time()
         self.logger.info(f"====== データ取得サイクル完了 (所要時間: {end_time - start_time:.2f}秒) ======")
+
+    async def _get_symbol_universe(self, session: aiohttp.ClientSession) -> List[str]:
+        """銘柄一覧を取得する。失敗した場合は最後に取得できた銘柄一覧 (なければDBに保存済みの銘柄) を使う"""
+        symbols = await self.client.get_all_linear_symbols(session)
+        if symbols:
+            self.last_symbols = symbols
+            return symbols
+
+        if self.last_symbols:
+            self.logger.warning(f"銘柄一覧の取得に失敗したため、前回取得した {len(self.last_symbols)} 銘柄を使用します。")
+            return self.last_symbols
+
+        known_symbols = self.repository.load_known_symbols()
+        if known_symbols:
+            self.logger.warning(f"銘柄一覧の取得に失敗したため、DBに保存済みの {len(known_symbols)} 銘柄を使用します。")
+        return known_symbols
+
+    def _store(self, timeframe: str, fetched: Iterable[Tuple[str, Optional[List[List[Any]]]]]):
+        with self._span(f"upsert {timeframe}"):
+            records_to_upsert = []
+            for symbol, ohlcv_data in fetched:
+                if ohlcv_data:
+                    for row in ohlcv_data:
+                        records_to_upsert.append((
+                            symbol, row[0], row[1], row[2], row[3], row[4], row[5], row[6]
+                        ))
+
+            if records_to_upsert:
+                self.repository.upsert_ohlcv_data(timeframe, records_to_upsert)
+
+        if records_to_upsert:
+            with self._span(f"cleanup {timeframe}"):
+                upserted_symbols = {rec[0] for rec in records_to_upsert}
+                self.repository.cleanup_old_ohlcv_data(timeframe, upserted_symbols, self.config.ohlcv_history_limit)
+
+    async def _retry_one(self, session: aiohttp.ClientSession, job: RetryJob) -> Tuple[RetryJob, Optional[List[List[Any]]], Optional[FetchError]]:
+        interval = TIMEFRAME_MAP[job.timeframe]
+        try:
+            data = await self.client.get_kline_data(session, job.symbol, interval, limit=self.config.fetch_limit)
+            return job, data, None
+        except FetchError as e:
+            return job, None, e
+
+    async def _retry_failed(self, session: aiohttp.ClientSession, queue: RetryQueue, deadline: float):
+        """
+        失敗した (timeframe, symbol) を、再試行可能時刻の早い順に同じサイクル内で再取得する。
+        サイクルあたりの再試行回数 (RETRY_BUDGET_PER_CYCLE) と期限 (RETRY_DEADLINE_SECONDS) の範囲で行い、
+        サーキットブレーカーが遮断中の間は待機する。
+        """
+        self.logger.info(f"--- 失敗した {len(queue)} 件のリクエストを再試行します ---")
+        budget = self.config.retry_budget_per_cycle
+        breaker = self.client.get_breaker()
+        recovered: Dict[str, List[Tuple[str, List[List[Any]]]]] = defaultdict(list)
+        running: Set[asyncio.Task] = set()
+        gave_up = 0
+
+        while queue or running:
+            now = time.monotonic()
+            wait: Optional[float] = None
+            if queue and budget > 0 and now < deadline and len(running) < self.config.concurrency_limit:
+                wait = max(queue.next_delay(), breaker.remaining_cooldown())
+                if wait <= 0:
+                    budget -= 1
+                    running.add(asyncio.create_task(self._retry_one(session, queue.pop())))
+                    continue
+                wait = min(wait, deadline - now)
+            elif not running:
+                # 再試行の予算または期限を使い切った
+                break
+
+            if not running:
+                await asyncio.sleep(wait)
+                continue
+
+            done, running = await asyncio.wait(running, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                job, data, error = task.result()
+                if error is None:
+                    if data:
+                        recovered[job.timeframe].append((job.symbol, data))
+                    continue
+                if isinstance(error, CircuitOpenError):
+                    # 送信していないので予算と試行回数を消費しない
+                    budget += 1
+                    queue.push(job.timeframe, job.symbol, job.attempts, error.retry_after or 0.0, job.last_error)
+                elif job.attempts + 1 < self.config.retry_max_attempts:
+                    delay = backoff_delay(job.attempts, self.config.retry_base_delay_seconds,
+                                          self.config.retry_max_delay_seconds, error.retry_after)
+                    queue.push(job.timeframe, job.symbol, job.attempts + 1, delay, str(error))
+                else:
+                    gave_up += 1
+                    self.logger.warning(f"{job.symbol} ({job.timeframe}) の再試行を断念しました: {error}")
+
+        remaining = queue.drain()
+        if remaining:
+            self.logger.warning(
+                f"再試行の予算または期限に達したため、{len(remaining)} 件は取得できませんでした (次のサイクルで再取得します)。"
+                f"(残り予算: {budget}, 例: {remaining[0].symbol} ({remaining[0].timeframe}): {remaining[0].last_error})"
+            )
+
+        recovered_count = sum(len(items) for items in recovered.values())
+        self.logger.info(f"--- 再試行が完了: {recovered_count} 件を回復、{gave_up} 件を断念 ---")
+        for timeframe, items in recovered.items():
+            self._store(timeframe, items)
+
+    async def _repair_gaps(self, session: aiohttp.ClientSession):
+        """
+        保存済みの足の欠損を検出し、欠損範囲だけを start/end 指定で取得して補完する。
+        通常の取得と再試行が終わった後に、少ない同時実行数と1サイクルあたりの予算、
+        補完の開始から GAP_REPAIR_DEADLINE_SECONDS 秒の期限の範囲で実行する。
+        """
+        jobs: List[Tuple[str, str, int, int]] = []
+        current_gaps: Set[Tuple[str, str, int, int]] = set()
+        for timeframe in self.config.timeframes:
+            timeframe = timeframe.strip()
+            interval_ms = TIMEFRAME_INTERVAL_MS.get(timeframe)
+            if not interval_ms or timeframe not in TIMEFRAME_MAP:
+                continue
+
+            gaps = self.repository.find_gaps(timeframe, interval_ms)
+            missing = 0
+            for symbol, prev_ts, next_ts in gaps:
+                missing += (next_ts - prev_ts) // interval_ms - 1
+                # Bybitの1リクエストの上限本数ごとに範囲を分割する
+                start = prev_ts + interval_ms
+                while start < next_ts:
+                    end = min(next_ts - interval_ms, start + (KLINE_MAX_LIMIT - 1) * interval_ms)
+                    key = (timeframe, symbol, start, end)
+                    current_gaps.add(key)
+                    if key not in self.unfillable_gaps:
+                        jobs.append(key)
+                    start = end + interval_ms
+            if gaps:
+                self.logger.info(
+                    f"[{timeframe}] 欠損を検出: {len({g[0] for g in gaps})} 銘柄, {len(gaps)} 箇所, {missing} 本"
+                )
+
+        # 解消された欠損は記録から外す
+        self.unfillable_gaps &= current_gaps
+        if not jobs:
+            return
+
+        # 新しい欠損ほど利用価値が高いため優先する
+        jobs.sort(key=lambda job: job[3], reverse=True)
+        budget = self.config.gap_repair_budget_per_cycle
+        if len(jobs) > budget:
+            self.logger.info(f"欠損補完の予算 ({budget} 件) を超えるため、{len(jobs) - budget} 件は次のサイクルで補完します。")
+            jobs = jobs[:budget]
+
+        self.logger.info(f"--- {len(jobs)} 件の欠損範囲を補完します ---")
+        sem = asyncio.Semaphore(self.config.gap_repair_concurrency)
+        breaker = self.client.get_breaker()
+        deadline = time.monotonic() + self.config.gap_repair_deadline_seconds
+        skipped = {"deadline": 0, "circuit_open": 0, "failed": 0}
+
+        async def repair_one(job: Tuple[str, str, int, int]):
+            timeframe, symbol, start, end = job
+            async with sem:
+                if time.monotonic() >= deadline:
+                    skipped["deadline"] += 1
+                    return job, None
+                if breaker.remaining_cooldown() > 0:
+                    skipped["circuit_open"] += 1
+                    return job, None
+                limit = (end - start) // TIMEFRAME_INTERVAL_MS[timeframe] + 1
+                try:
+                    data = await self.client.get_kline_data(
+                        session, symbol, TIMEFRAME_MAP[timeframe], limit=limit, start=start, end=end
+                    )
+                except FetchError as e:
+                    if isinstance(e, CircuitOpenError):
+                        skipped["circuit_open"] += 1
+                    else:
+                        skipped["failed"] += 1
+                        self.logger.warning(f"{symbol} ({timeframe}) の欠損補完に失敗しました: {e}")
+                    return job, None
+                if data is not None:
+                    # 取引所にも存在しない足 (取引停止期間など) は、次回以降に補完を試みない
+                    present = {row[0] for row in data}
+                    interval_ms = TIMEFRAME_INTERVAL_MS[timeframe]
+                    run_start = None
+                    for ts in range(start, end + interval_ms, interval_ms):
+                        if ts not in present and run_start is None:
+                            run_start = ts
+                        elif ts in present and run_start is not None:
+                            self.unfillable_gaps.add((timeframe, symbol, run_start, ts - interval_ms))
+                            run_start = None
+                    if run_start is not None:
+                        self.unfillable_gaps.add((timeframe, symbol, run_start, end))
+                return job, data
+
+        results = await asyncio.gather(*(repair_one(job) for job in jobs))
+
+        repaired: Dict[str, List[Tuple[str, List[List[Any]]]]] = defaultdict(list)
+        for (timeframe, symbol, start, end), data in results:
+            if data:
+                repaired[timeframe].append((symbol, [row for row in data if start <= row[0] <= end]))
+        for timeframe, items in repaired.items():
+            self._store(timeframe, items)
+
+        repaired_count = sum(len(rows) for items in repaired.values() for _, rows in items)
+        self.logger.info(f"--- 欠損補完が完了: {repaired_count} 本を補完 ---")
+        if any(skipped.values()):
+            self.logger.warning(
+                f"欠損補完で {sum(skipped.values())} 件を補完できませんでした (次のサイクルで再試行します)。"
+                f"(期限切れ: {skipped['deadline']}, サーキットブレーカー遮断中: {skipped['circuit_open']}, "
+                f"取得失敗: {skipped['failed']})"
+            )
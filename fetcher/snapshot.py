@@ -0,0 +1,135 @@
+"""
+API向けの共有マーケットスナップショットの書き出し。
+
+タイムフレームごとに snapshot_{tf}.bin を作成し、一時ファイルに書いてから rename で差し替える。
+APIの各ワーカーはこのファイルを読み取り専用で mmap し、NumPyのビューとして直接参照する。
+
+ファイル形式 (リトルエンディアン。api/snapshot.py と同じ定義):
+    ヘッダー (SNAPSHOT_HEADER)
+    銘柄インデックス: 銘柄名を "\\n" 区切りにしたUTF-8 (銘柄名の昇順)
+    timestamp: int64[n_symbols, depth]   各銘柄の足を新しい順に格納。足がない位置は0
+    close:     float64[n_symbols, depth]
+    volume:    float64[n_symbols, depth]
+    turnover:  float64[n_symbols, depth]
+    counts:    int32[n_symbols]          各銘柄の有効な足の本数
+各セクションの開始位置は SNAPSHOT_ALIGN バイト境界に揃える。
+"""
+import logging
+import os
+import sqlite3
+import struct
+import time
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from repository import DatabaseRepository
+
+SNAPSHOT_MAGIC = b"CMMASNAP"
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_ALIGN = 64
+# magic, format_version, n_symbols, depth, reserved, generation, created_at_ms,
+# symbols_offset, symbols_size, ts_offset, close_offset, volume_offset, turnover_offset, counts_offset
+SNAPSHOT_HEADER = struct.Struct("<8sIIIIqqQQQQQQQ")
+
+
+def _align(offset: int) -> int:
+    return (offset + SNAPSHOT_ALIGN - 1) // SNAPSHOT_ALIGN * SNAPSHOT_ALIGN
+
+
+def get_snapshot_path(snapshot_dir: Path, timeframe: str) -> Path:
+    return snapshot_dir / f"snapshot_{timeframe}.bin"
+
+
+def write_snapshot(path: Path, rows: List[tuple], generation: int):
+    """fetch_snapshot_rows の結果からスナップショットファイルを作成し、アトミックに差し替える"""
+    if rows:
+        sym_col, pos_col, ts_col, close_col, volume_col, turnover_col = zip(*rows)
+        symbols, sym_idx = np.unique(np.array(sym_col, dtype=object), return_inverse=True)
+        pos = np.array(pos_col, dtype=np.int64)
+        depth = int(pos.max()) + 1
+    else:
+        symbols, sym_idx, pos, depth = np.array([], dtype=object), np.array([], dtype=np.int64), np.array([], dtype=np.int64), 0
+        ts_col = close_col = volume_col = turnover_col = ()
+
+    n_symbols = len(symbols)
+    timestamps = np.zeros((n_symbols, depth), dtype="<i8")
+    close = np.zeros((n_symbols, depth), dtype="<f8")
+    volume = np.zeros((n_symbols, depth), dtype="<f8")
+    turnover = np.zeros((n_symbols, depth), dtype="<f8")
+    timestamps[sym_idx, pos] = ts_col
+    close[sym_idx, pos] = close_col
+    volume[sym_idx, pos] = volume_col
+    turnover[sym_idx, pos] = turnover_col
+    counts = np.bincount(sym_idx, minlength=n_symbols).astype("<i4")
+
+    symbols_bytes = "\n".join(symbols.tolist()).encode("utf-8")
+    sections = [symbols_bytes, timestamps.tobytes(), close.tobytes(), volume.tobytes(), turnover.tobytes(), counts.tobytes()]
+    offsets = []
+    offset = SNAPSHOT_HEADER.size
+    for section in sections:
+        offset = _align(offset)
+        offsets.append(offset)
+        offset += len(section)
+
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, n_symbols, depth, 0, generation, int(time.time() * 1000),
+        offsets[0], len(symbols_bytes), offsets[1], offsets[2], offsets[3], offsets[4], offsets[5]
+    )
+
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        for section_offset, section in zip(offsets, sections):
+            f.write(b"\0" * (section_offset - f.tell()))
+            f.write(section)
+        f.flush()
+        os.fsync(f.fileno())
+    # 読み取り中のワーカーは古いファイルのmmapを使い続け、次のリクエストから新しいファイルを開く
+    os.replace(tmp_path, path)
+
+
+class SnapshotPublisher:
+    """データ取得サイクルの完了後に、タイムフレームごとのスナップショットを書き出す"""
+
+    def __init__(self, repository: DatabaseRepository, snapshot_dir: Path, depth: int, logger: logging.Logger):
+        self.repository = repository
+        self.snapshot_dir = snapshot_dir
+        self.depth = depth
+        self.logger = logger
+        self.published_generation = None
+
+    def _touch(self, timeframes: List[str]) -> bool:
+        """
+        書き出し済みのスナップショットの更新時刻だけを進め、APIに最新のデータであることを示す
+        (APIは更新時刻の古いスナップショットを使わない)。ファイルがなくなっていた場合は False を返す。
+        """
+        try:
+            for timeframe in timeframes:
+                timeframe = timeframe.strip()
+                if timeframe:
+                    os.utime(get_snapshot_path(self.snapshot_dir, timeframe))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def publish(self, timeframes: List[str]):
+        start = time.time()
+        try:
+            generation = self.repository.get_latest_change_seq()
+            if generation == self.published_generation and self._touch(timeframes):
+                self.logger.info("前回のスナップショット以降に変更がないため、書き出しをスキップします。")
+                return
+
+            self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+            for timeframe in timeframes:
+                timeframe = timeframe.strip()
+                if not timeframe: continue
+                rows = self.repository.fetch_snapshot_rows(timeframe, self.depth)
+                write_snapshot(get_snapshot_path(self.snapshot_dir, timeframe), rows, generation)
+        except (OSError, ValueError, sqlite3.Error) as e:
+            self.logger.error(f"スナップショットの書き出し中にエラー: {e}")
+            return
+        self.published_generation = generation
+        self.logger.info(f"スナップショット (世代 {generation}) を書き出しました ({time.time() - start:.2f}秒)")
@@ -0,0 +1,88 @@
+import logging
+import random
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+# fetcherの書き込み処理 (DatabaseRepository) をそのまま使い、本番と同じスキーマ・同じUPSERT経路でDBを作る
+FETCHER_DIR = Path(__file__).resolve().parent.parent / "fetcher"
+if str(FETCHER_DIR) not in sys.path:
+    sys.path.insert(0, str(FETCHER_DIR))
+
+from repository import create_repository  # noqa: E402
+from snapshot import SnapshotPublisher  # noqa: E402
+
+# タイムフレームごとの足の間隔 (ミリ秒)。1Mは30日として扱う
+TIMEFRAME_MS = {
+    "1m": 60_000, "5m": 300_000, "15m": 900_000, "30m": 1_800_000,
+    "1h": 3_600_000, "4h": 14_400_000, "1d": 86_400_000,
+    "1w": 604_800_000, "1M": 2_592_000_000,
+}
+
+
+def synthetic_symbols(count: int) -> List[str]:
+    """BTCUSDT風の合成シンボル名を生成する"""
+    return [f"SYN{i:04d}USDT" for i in range(count)]
+
+
+def latest_candle_ts(timeframe: str, now_ms: int) -> int:
+    step = TIMEFRAME_MS[timeframe]
+    return now_ms - (now_ms % step)
+
+
+def generate_candles(symbol: str, timeframe: str, history: int, end_ts: int, rng: random.Random) -> List[Tuple]:
+    """ランダムウォークでOHLCVの行 (fetcherのrecord形式) を生成する"""
+    step = TIMEFRAME_MS[timeframe]
+    price = 10 ** rng.uniform(-3, 4)
+    records = []
+    for i in range(history):
+        ts = end_ts - (history - 1 - i) * step
+        open_ = price
+        close = max(open_ * (1 + rng.gauss(0, 0.01)), 1e-8)
+        high = max(open_, close) * (1 + abs(rng.gauss(0, 0.003)))
+        low = min(open_, close) * (1 - abs(rng.gauss(0, 0.003)))
+        volume = rng.uniform(1_000, 5_000_000)
+        records.append((symbol, ts, open_, high, low, close, volume, volume * close))
+        price = close
+    return records
+
+
+def build_database(db_file: Path, symbols: List[str], timeframes: List[str], history: int,
+                   logger: logging.Logger, seed: int = 42, storage_format: str = "legacy",
+                   price_scale_decimals: int = 0) -> None:
+    """合成データで負荷試験用のcmma.dbを作成する (既存ファイルは作り直す)"""
+    if db_file.exists():
+        db_file.unlink()
+    rng = random.Random(seed)
+    now_ms = int(time.time() * 1000)
+
+    repo = create_repository(storage_format, db_file, timeframes, logger, price_scale_decimals)
+    try:
+        for tf in timeframes:
+            end_ts = latest_candle_ts(tf, now_ms)
+            records = []
+            for symbol in symbols:
+                records.extend(generate_candles(symbol, tf, history, end_ts, rng))
+            repo.upsert_ohlcv_data(tf, records)
+    finally:
+        repo.close()
+
+
+def publish_snapshot(db_file: Path, timeframes: List[str], history: int, snapshot_dir: Path,
+                     logger: logging.Logger, storage_format: str = "legacy", price_scale_decimals: int = 0) -> None:
+    """DBの現在の内容から共有スナップショットを書き出す (DBを再利用する場合も計測前に必ず作り直す)"""
+    repo = create_repository(storage_format, db_file, timeframes, logger, price_scale_decimals)
+    try:
+        SnapshotPublisher(repo, snapshot_dir, history, logger).publish(timeframes)
+    finally:
+        repo.close()
+
+
+def latest_update_records(symbols: List[str], timeframe: str, candles: int, rng: random.Random) -> List[Tuple]:
+    """fetcherの1サイクル分に相当する、直近の足の更新レコードを生成する"""
+    end_ts = latest_candle_ts(timeframe, int(time.time() * 1000))
+    records = []
+    for symbol in symbols:
+        records.extend(generate_candles(symbol, timeframe, candles, end_ts, rng))
+    return records
@@ -0,0 +1,174 @@
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from dataset import build_database, publish_snapshot, synthetic_symbols
+from report import compare_with_baseline, format_summary, load_baseline, save_report, summarize
+from runner import ApiServer, FetcherSimulator, QueryMix, run_step
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="CMMA API 負荷試験ツール")
+    # データセット
+    parser.add_argument("--symbols", type=int, default=500, help="合成する銘柄数")
+    parser.add_argument("--timeframes", default="5m,1h,4h,1d", help="作成するタイムフレーム (カンマ区切り)")
+    parser.add_argument("--history", type=int, default=1000, help="銘柄ごとの足の本数 (OHLCV_HISTORY_LIMIT)")
+    parser.add_argument("--db", type=Path, default=None, help="合成DBの出力先。省略時は一時ディレクトリ")
+    parser.add_argument("--storage-format", choices=["legacy", "compact"], default="legacy",
+                        help="テーブルレイアウト (STORAGE_FORMAT)")
+    parser.add_argument("--price-decimals", type=int, default=0,
+                        help="compactレイアウトで価格を整数保存する際の小数桁数 (PRICE_SCALE_DECIMALS)")
+    parser.add_argument("--reuse-db", action="store_true", help="--db が既に存在する場合は再生成しない")
+    # 負荷
+    parser.add_argument("--rates", default="20,50,100", help="到着率 (req/s) のステップ (カンマ区切り)")
+    parser.add_argument("--duration", type=float, default=30.0, help="各ステップの計測時間 (秒)")
+    parser.add_argument("--warmup", type=float, default=5.0, help="計測前のウォームアップ時間 (秒)")
+    parser.add_argument("--arrival", choices=["constant", "poisson"], default="poisson", help="到着間隔の分布")
+    parser.add_argument("--volume-ratio", type=float, default=0.4, help="/volume リクエストの割合")
+    parser.add_argument("--timeout", type=float, default=10.0, help="リクエストのタイムアウト (秒)")
+    parser.add_argument("--seed", type=int, default=42)
+    # サーバー
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="uvicornのワーカー数")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="共有スナップショット (SNAPSHOT_ENABLED) を書き出し、APIにmmap経由で計算させる")
+    # fetcher書き込みの模擬
+    parser.add_argument("--with-writer", action="store_true", help="計測中にfetcherの書き込みサイクルを模擬する")
+    parser.add_argument("--writer-candles", type=int, default=5, help="1サイクルで更新する銘柄ごとの足の本数")
+    parser.add_argument("--writer-interval", type=float, default=5.0, help="書き込みサイクルの間隔 (秒)")
+    # 結果とベースライン
+    parser.add_argument("--output", type=Path, default=None, help="結果JSONの出力先")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="比較対象のベースラインJSON")
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果でベースラインを上書きする")
+    parser.add_argument("--latency-tolerance", type=float, default=0.2, help="レイテンシ悪化の許容率 (0.2 = +20%%)")
+    parser.add_argument("--throughput-tolerance", type=float, default=0.1, help="スループット低下の許容率")
+    parser.add_argument("--error-rate-tolerance", type=float, default=0.001, help="エラー率増加の許容幅 (絶対値)")
+    return parser.parse_args(argv)
+
+
+def setup_logging() -> logging.Logger:
+    formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(formatter)
+    logger = logging.getLogger("LoadTest")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    logger.propagate = False
+    return logger
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logger = setup_logging()
+
+    timeframes = [tf.strip() for tf in args.timeframes.split(",") if tf.strip()]
+    rates = [float(r) for r in args.rates.split(",") if r.strip()]
+    symbols = synthetic_symbols(args.symbols)
+
+    tmp_dir = None
+    db_file = args.db
+    if db_file is None:
+        tmp_dir = tempfile.TemporaryDirectory(prefix="cmma-loadtest-")
+        db_file = Path(tmp_dir.name) / "cmma.db"
+
+    snapshot_dir = db_file.parent / "snapshots" if args.snapshot else None
+
+    # DatabaseRepositoryのINFOログは大量に出るため、データ生成中はWARNING以上に絞る
+    repo_logger = logging.getLogger("LoadTestRepository")
+    repo_logger.setLevel(logging.WARNING)
+
+    if args.reuse_db and db_file.exists():
+        logger.info(f"既存の合成DBを再利用します: {db_file}")
+    else:
+        logger.info(f"合成DBを作成中: {db_file} ({len(symbols)}銘柄 x {timeframes} x {args.history}本)")
+        build_database(db_file, symbols, timeframes, args.history, repo_logger, seed=args.seed,
+                       storage_format=args.storage_format, price_scale_decimals=args.price_decimals)
+        logger.info(f"合成DBの作成完了 ({db_file.stat().st_size / 1024 / 1024:.1f} MB)")
+
+    if snapshot_dir is not None:
+        publish_snapshot(db_file, timeframes, args.history, snapshot_dir, repo_logger,
+                         storage_format=args.storage_format, price_scale_decimals=args.price_decimals)
+        logger.info(f"共有スナップショットを書き出しました: {snapshot_dir}")
+
+    scenario = {
+        "symbols": args.symbols,
+        "timeframes": timeframes,
+        "history": args.history,
+        "storage_format": args.storage_format,
+        "price_decimals": args.price_decimals,
+        "arrival": args.arrival,
+        "volume_ratio": args.volume_ratio,
+        "workers": args.workers,
+        "snapshot": args.snapshot,
+        "with_writer": args.with_writer,
+    }
+
+    server = ApiServer(db_file, args.storage_format, args.history, args.port, args.workers, logger, snapshot_dir)
+    writer = None
+    steps = []
+    try:
+        server.start()
+        if args.with_writer:
+            writer = FetcherSimulator(db_file, args.storage_format, args.price_decimals, symbols, timeframes,
+                                      args.history, args.writer_candles, args.writer_interval, snapshot_dir)
+            writer.start()
+            logger.info("fetcher書き込みサイクルの模擬を開始しました。")
+
+        rng = random.Random(args.seed)
+        mix = QueryMix(timeframes, args.history, args.volume_ratio, rng)
+        if args.warmup > 0:
+            logger.info(f"ウォームアップ中 ({args.warmup}秒)...")
+            asyncio.run(run_step(server.base_url, mix, rates[0], args.warmup, args.arrival, args.timeout, rng))
+
+        for rate in rates:
+            logger.info(f"計測中: {rate:g} req/s x {args.duration}秒")
+            step = asyncio.run(run_step(server.base_url, mix, rate, args.duration, args.arrival, args.timeout, rng))
+            summary = summarize(step)
+            steps.append(summary)
+            logger.info(format_summary(summary))
+    finally:
+        if writer:
+            writer.stop()
+        server.stop()
+        if tmp_dir:
+            tmp_dir.cleanup()
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "scenario": scenario,
+        "steps": steps,
+    }
+    if args.output:
+        save_report(args.output, report)
+        logger.info(f"結果を保存しました: {args.output}")
+
+    if args.update_baseline:
+        save_report(args.baseline, report)
+        logger.info(f"ベースラインを更新しました: {args.baseline}")
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        logger.warning(f"ベースラインが見つからないため比較をスキップします: {args.baseline}")
+        return 0
+
+    regressions = compare_with_baseline(
+        report, baseline, args.latency_tolerance, args.throughput_tolerance, args.error_rate_tolerance
+    )
+    if regressions:
+        for message in regressions:
+            logger.error(f"回帰を検出: {message}")
+        return 1
+    logger.info("ベースラインとの比較: 回帰なし")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import json
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from runner import StepResult
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """線形補間によるパーセンタイル (sorted_values は昇順ソート済み)"""
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100
+    lower = int(k)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (k - lower)
+
+
+def summarize(step: StepResult) -> Dict[str, Any]:
+    """1ステップ分の結果から、スループット・レイテンシ・エラー率を集計する"""
+    total = len(step.results)
+    ok = [r for r in step.results if r.ok]
+    latencies = sorted(r.latency_ms for r in ok)
+    by_endpoint = {}
+    for endpoint in sorted({r.endpoint for r in step.results}):
+        ep_results = [r for r in step.results if r.endpoint == endpoint]
+        ep_latencies = sorted(r.latency_ms for r in ep_results if r.ok)
+        by_endpoint[endpoint] = {
+            "requests": len(ep_results),
+            "errors": sum(1 for r in ep_results if not r.ok),
+            "p50_ms": round(percentile(ep_latencies, 50), 2),
+            "p99_ms": round(percentile(ep_latencies, 99), 2),
+        }
+    return {
+        "rate": step.rate,
+        "requests": total,
+        "errors": total - len(ok),
+        "error_rate": round((total - len(ok)) / total, 4) if total else 0.0,
+        "throughput_rps": round(len(ok) / step.elapsed, 2) if step.elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "error_kinds": dict(Counter(r.error or f"HTTP {r.status}" for r in step.results if not r.ok)),
+        "endpoints": by_endpoint,
+    }
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    lines = [
+        f"rate={summary['rate']:g} req/s: {summary['requests']} requests, "
+        f"throughput={summary['throughput_rps']} req/s, error_rate={summary['error_rate'] * 100:.2f}%, "
+        f"p50={summary['p50_ms']}ms p95={summary['p95_ms']}ms p99={summary['p99_ms']}ms"
+    ]
+    if summary["error_kinds"]:
+        lines.append(f"    errors: {summary['error_kinds']}")
+    for endpoint, stats in summary["endpoints"].items():
+        lines.append(
+            f"    {endpoint}: {stats['requests']} requests, {stats['errors']} errors, "
+            f"p50={stats['p50_ms']}ms p99={stats['p99_ms']}ms"
+        )
+    return "\n".join(lines)
+
+
+def load_baseline(path: Path) -> Optional[Dict[str, Any]]:
+    if not path.exists():
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_report(path: Path, report: Dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+        f.write("\n")
+
+
+def compare_with_baseline(report: Dict[str, Any], baseline: Dict[str, Any], latency_tolerance: float,
+                          throughput_tolerance: float, error_rate_tolerance: float) -> List[str]:
+    """ベースラインと比較し、回帰している項目のメッセージ一覧を返す (空なら合格)"""
+    regressions = []
+    if baseline.get("scenario") != report.get("scenario"):
+        regressions.append(
+            f"シナリオがベースラインと一致しません: baseline={baseline.get('scenario')} current={report.get('scenario')}"
+        )
+        return regressions
+
+    baseline_steps = {step["rate"]: step for step in baseline.get("steps", [])}
+    for step in report["steps"]:
+        base = baseline_steps.get(step["rate"])
+        if base is None:
+            continue
+        rate = f"rate={step['rate']:g}"
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            limit = base[key] * (1 + latency_tolerance)
+            if step[key] > limit:
+                regressions.append(f"{rate}: {key} {step[key]}ms > 許容値 {limit:.2f}ms (baseline {base[key]}ms)")
+        min_throughput = base["throughput_rps"] * (1 - throughput_tolerance)
+        if step["throughput_rps"] < min_throughput:
+            regressions.append(
+                f"{rate}: throughput {step['throughput_rps']} req/s < 許容値 {min_throughput:.2f} req/s "
+                f"(baseline {base['throughput_rps']} req/s)"
+            )
+        max_error_rate = base["error_rate"] + error_rate_tolerance
+        if step["error_rate"] > max_error_rate:
+            regressions.append(
+                f"{rate}: error_rate {step['error_rate']} > 許容値 {max_error_rate:.4f} (baseline {base['error_rate']})"
+            )
+    return regressions
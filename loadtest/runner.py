@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from dataset import TIMEFRAME_MS, SnapshotPublisher, create_repository, latest_update_records
+
+API_DIR = Path(__file__).resolve().parent.parent / "api"
+# 計測中にAPIがスナップショットを期限切れとみなさないよう、十分に長い期限を渡す
+SNAPSHOT_MAX_AGE_SECONDS = 7 * 24 * 3600
+
+# APIの VALID_PERIODS と同じ期間指定 (分換算)
+PERIOD_MINUTES = {"1h": 60, "6h": 360, "12h": 720, "24h": 1440, "1d": 1440, "7d": 10080, "1w": 10080}
+
+
+@dataclass
+class RequestResult:
+    endpoint: str
+    latency_ms: float
+    status: int
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and 200 <= self.status < 300
+
+
+@dataclass
+class StepResult:
+    rate: float
+    duration: float
+    elapsed: float
+    results: List[RequestResult] = field(default_factory=list)
+
+
+class QueryMix:
+    """本番の利用状況を模した /volatility と /volume のリクエストを生成する"""
+
+    def __init__(self, timeframes: List[str], history: int, volume_ratio: float, rng: random.Random):
+        self.timeframes = timeframes
+        self.history = history
+        self.volume_ratio = volume_ratio
+        self.rng = rng
+        # OHLCV_HISTORY_LIMIT を超えない (timeframe, period) の組み合わせだけを使う
+        self.volume_combos = [
+            (tf, period) for tf in timeframes for period, minutes in PERIOD_MINUTES.items()
+            if minutes // (TIMEFRAME_MS[tf] // 60_000) <= history and minutes >= TIMEFRAME_MS[tf] // 60_000
+        ]
+
+    def next(self) -> Tuple[str, Dict[str, str]]:
+        if self.volume_combos and self.rng.random() < self.volume_ratio:
+            timeframe, period = self.rng.choice(self.volume_combos)
+            params = {
+                "timeframe": timeframe,
+                "period": period,
+                "sort": self.rng.choice(["volume_desc", "turnover_desc", "symbol_asc"]),
+                "limit": str(self.rng.choice([20, 100, 500])),
+            }
+            if self.rng.random() < 0.5:
+                params["min_volume"] = str(self.rng.choice([1e6, 1e8, 5e8]))
+            return "/volume", params
+
+        params = {
+            "timeframe": self.rng.choice(self.timeframes),
+            "threshold": str(self.rng.choice([0.5, 1, 2, 5, 10])),
+            "offset": str(self.rng.randint(1, max(1, min(self.history - 1, 24)))),
+            "direction": self.rng.choice(["up", "down", "both"]),
+            "sort": self.rng.choice(["volatility_desc", "volatility_asc", "symbol_asc"]),
+            "limit": str(self.rng.choice([20, 100, 500])),
+        }
+        return "/volatility", params
+
+
+async def _send(session: aiohttp.ClientSession, base_url: str, endpoint: str, params: Dict[str, str],
+                scheduled_at: float) -> RequestResult:
+    try:
+        async with session.get(f"{base_url}{endpoint}", params=params) as response:
+            await response.read()
+            status = response.status
+        error = None if status < 400 else f"HTTP {status}"
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        status, error = 0, type(e).__name__
+    # 予定送信時刻からの経過で測る (coordinated omissionを避けるため)
+    return RequestResult(endpoint, (time.perf_counter() - scheduled_at) * 1000, status, error)
+
+
+async def run_step(base_url: str, mix: QueryMix, rate: float, duration: float, arrival: str,
+                   timeout: float, rng: random.Random) -> StepResult:
+    """固定到着率 (open loop) でリクエストを送り、全レスポンスの結果を集める"""
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    tasks = []
+    async with aiohttp.ClientSession(timeout=client_timeout, connector=connector) as session:
+        start = time.perf_counter()
+        next_at = start
+        while next_at - start < duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            endpoint, params = mix.next()
+            tasks.append(asyncio.create_task(_send(session, base_url, endpoint, params, next_at)))
+            gap = rng.expovariate(rate) if arrival == "poisson" else 1.0 / rate
+            next_at += gap
+        results = await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return StepResult(rate=rate, duration=duration, elapsed=elapsed, results=list(results))
+
+
+def _writer_loop(db_file: str, storage_format: str, price_scale_decimals: int, symbols: List[str],
+                 timeframes: List[str], history: int, candles: int, interval: float,
+                 snapshot_dir: Optional[str], stop: multiprocessing.Event) -> None:
+    """fetcherの書き込みサイクル (UPSERT + クリーンアップ) を一定間隔で繰り返す"""
+    logger = logging.getLogger("LoadTestWriter")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    rng = random.Random(7)
+    repo = create_repository(storage_format, Path(db_file), timeframes, logger, price_scale_decimals)
+    publisher = SnapshotPublisher(repo, Path(snapshot_dir), history, logger) if snapshot_dir else None
+    try:
+        while not stop.is_set():
+            for tf in timeframes:
+                records = latest_update_records(symbols, tf, candles, rng)
+                repo.upsert_ohlcv_data(tf, records)
+                repo.cleanup_old_ohlcv_data(tf, set(symbols), history)
+            if publisher:
+                publisher.publish(timeframes)
+            stop.wait(interval)
+    finally:
+        repo.close()
+
+
+class FetcherSimulator:
+    """API計測と並行して、別プロセスでfetcherの書き込みを再現する"""
+
+    def __init__(self, db_file: Path, storage_format: str, price_scale_decimals: int, symbols: List[str],
+                 timeframes: List[str], history: int, candles: int, interval: float,
+                 snapshot_dir: Optional[Path] = None):
+        self._stop = multiprocessing.Event()
+        self._process = multiprocessing.Process(
+            target=_writer_loop,
+            args=(str(db_file), storage_format, price_scale_decimals, symbols, timeframes, history,
+                  candles, interval, str(snapshot_dir) if snapshot_dir else None, self._stop),
+            daemon=True,
+        )
+
+    def start(self):
+        self._process.start()
+
+    def stop(self):
+        self._stop.set()
+        self._process.join(timeout=60)
+        if self._process.is_alive():
+            self._process.terminate()
+
+
+class ApiServer:
+    """合成DBを参照するuvicornサーバーをサブプロセスで起動する"""
+
+    def __init__(self, db_file: Path, storage_format: str, history: int, port: int, workers: int,
+                 logger: logging.Logger, snapshot_dir: Optional[Path] = None):
+        self.db_file = db_file
+        self.storage_format = storage_format
+        self.snapshot_dir = snapshot_dir
+        self.history = history
+        self.port = port
+        self.workers = workers
+        self.logger = logger
+        self.base_url = f"http://127.0.0.1:{port}"
+        self._process: Optional[subprocess.Popen] = None
+
+    def start(self, ready_timeout: float = 30.0):
+        env = dict(os.environ)
+        env["DATABASE_URL"] = f"sqlite:///{self.db_file.resolve()}"
+        env["OHLCV_HISTORY_LIMIT"] = str(self.history)
+        env["STORAGE_FORMAT"] = self.storage_format
+        env["SNAPSHOT_ENABLED"] = "true" if self.snapshot_dir else "false"
+        if self.snapshot_dir:
+            env["SNAPSHOT_DIR"] = str(self.snapshot_dir.resolve())
+            # --with-writer なしでは計測中にスナップショットが更新されないため、期限切れでDBに切り替わらないようにする
+            env["SNAPSHOT_MAX_AGE_SECONDS"] = str(SNAPSHOT_MAX_AGE_SECONDS)
+        cmd = [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1", "--port", str(self.port),
+            "--workers", str(self.workers), "--log-level", "warning",
+        ]
+        self.logger.info(f"APIサーバーを起動: {' '.join(cmd)}")
+        self._process = subprocess.Popen(cmd, cwd=API_DIR, env=env)
+        asyncio.run(self._wait_ready(ready_timeout))
+
+    async def _wait_ready(self, ready_timeout: float):
+        deadline = time.monotonic() + ready_timeout
+        async with aiohttp.ClientSession() as session:
+            while time.monotonic() < deadline:
+                if self._process.poll() is not None:
+                    raise RuntimeError(f"APIサーバーが終了しました (exit code: {self._process.returncode})")
+                try:
+                    async with session.get(f"{self.base_url}/") as response:
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.2)
+        raise RuntimeError(f"APIサーバーが {ready_timeout} 秒以内に起動しませんでした")
+
+    def stop(self):
+        if self._process and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._process.kill()